@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+"""Compare the json backends of glitter.codec on Gitter payloads
+
+The fixtures are a rooms listing, a page of chatMessages and the
+same messages as stream lines, shaped like the Gitter api responses.
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from glitter import codec
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def load_payloads(scale):
+    payloads = {}
+    for name in ('rooms', 'chatMessages'):
+        with open(os.path.join(FIXTURES, name + '.json'), 'rb') as instream:
+            obj = json.loads(instream.read().decode('utf-8'))
+        payloads[name] = json.dumps(obj * scale).encode('utf-8')
+        if name == 'chatMessages':
+            payloads['stream'] = [json.dumps(m).encode('utf-8') for m in obj]
+    return payloads
+
+
+def bench_backend(name, payloads, repeat, number):
+    loads, dumps = codec.get_backend(name)
+    results = {}
+    for payload, data in sorted(payloads.items()):
+        if isinstance(data, list):
+            def run():
+                for line in data:
+                    loads(line)
+        else:
+            def run():
+                loads(data)
+        best = min(timeit.repeat(run, repeat=repeat, number=number))
+        results['loads ' + payload] = best / number
+
+    messages = loads(payloads['chatMessages'])
+    best = min(timeit.repeat(lambda: dumps(messages),
+                             repeat=repeat, number=number))
+    results['dumps chatMessages'] = best / number
+    return results
+
+
+def main(cmdline=None):
+    parser = make_parser()
+    args = parser.parse_args(cmdline)
+
+    payloads = load_payloads(args.scale)
+    backends = args.backend or codec.backends()
+    report = {}
+    for name in backends:
+        report[name] = bench_backend(name, payloads, args.repeat, args.number)
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        print()
+        return
+
+    cases = sorted(report[backends[0]])
+    print('%-24s' % 'case' + ''.join('%12s' % name for name in backends))
+    for case in cases:
+        print('%-24s' % case +
+              ''.join('%10.1fus' % (report[name][case] * 1e6)
+                      for name in backends))
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backend', action='append',
+                        choices=codec.PREFERRED_BACKENDS,
+                        help='backend to measure, defaults to all installed')
+    parser.add_argument('--scale', type=int, default=20,
+                        help='copies of each fixture in the REST payloads')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--number', type=int, default=20)
+    parser.add_argument('--json', action='store_true', default=False,
+                        help='print machine readable results')
+    return parser
+
+
+if __name__ == '__main__':
+    main()
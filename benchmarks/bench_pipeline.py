@@ -0,0 +1,346 @@
+#!/usr/bin/python3
+"""Measure the streamed message pipeline from socket bytes to D-Bus
+
+Stream lines are fed to Room.receiveMessageStream as if they had just
+arrived. They are decoded on the ingest thread, stored through
+Message.loadJson and Messages.__setitem__, and emitted by
+GlitterTextChannel._signal_text_received on a private session bus.
+Both payload kinds are synthetic: fixture reuses the generated
+chatMessages fixture from bench_json, which has every field gitter
+sends, and random takes fakegitter's random messages.
+
+Every combination of room count and burst size reports messages per
+second, CPU per message and peak RSS. The peak is reset before each
+case on Linux, elsewhere it is the peak of the whole run so far. --allocations adds a second pass
+under tracemalloc. Each stage is also timed on its own. Results are
+written as json, and --compare prints the change from an earlier
+results file.
+"""
+import argparse
+import collections
+import copy
+import datetime
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import dbus
+import dbus.service
+import telepathy
+from dbus.mainloop.pyqt5 import DBusQtMainLoop
+from PyQt5.QtCore import QCoreApplication, QEventLoop, QStandardPaths
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, TOP)
+
+from glitter import codec
+from glitter.channel.text import GlitterTextChannel
+from glitter.ingest import normalize
+from glitter.rooms import Message, Room
+
+from bench_startup import start_bus
+from fakegitter import Gitter, load_fixture
+
+BUS_NAME = 'org.glitter.BenchPipeline'
+# seconds to wait for a burst to make it through
+DRAIN_TIMEOUT = 60
+# where each payload kind comes from, saved with the results
+PAYLOADS = {
+    'fixture': 'generated chatMessages fixture, random words',
+    'random': 'fakegitter random messages',
+}
+
+
+class StreamChunk(object):
+    """The part of a streaming QNetworkReply readLines uses
+    """
+    def __init__(self, lines):
+        self._lines = collections.deque(lines)
+
+    def canReadLine(self):
+        return bool(self._lines)
+
+    def readLine(self):
+        return self._lines.popleft()
+
+    def error(self):
+        return 0
+
+
+def make_payloads(kind, gitter, count):
+    """Return count message records of kind fixture or random
+    """
+    if kind == 'random':
+        return [gitter.randomMessage() for _ in range(count)]
+    fixture = load_fixture('chatMessages')
+    return [dict(copy.deepcopy(fixture[i % len(fixture)]),
+                 id=gitter.newId())
+            for i in range(count)]
+
+
+def reset_peak_rss():
+    """Restart the kernel's peak RSS count, False where it can't be
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as outstream:
+            outstream.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_kb():
+    try:
+        with open('/proc/self/status') as instream:
+            for line in instream:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def encode(records):
+    return [json.dumps(record).encode('utf-8') + b'\n' for record in records]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=TOP,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class ChannelSink(dbus.service.Object):
+    """Just enough of a text channel to emit its signals on the bus
+    """
+    _signal_text_received = GlitterTextChannel._signal_text_received
+
+    def __init__(self, bench, room, path):
+        super().__init__(bench.bus_name, path)
+        self._bench = bench
+        self._room = room
+        self._pending_counter = itertools.count()
+        room.messagesReceived.connect(self._signal_text_received)
+
+    @dbus.service.signal(telepathy.CHANNEL_TYPE_TEXT, signature='uuuuus')
+    def Received(self, id, timestamp, sender, type, flags, text):
+        pass
+
+    @dbus.service.signal(telepathy.CHANNEL_INTERFACE_MESSAGES,
+                         signature='aa{sv}')
+    def MessageReceived(self, message):
+        self._bench.emitted += 1
+
+
+class Bench(object):
+    def __init__(self, args):
+        # everything glitter writes goes somewhere disposable
+        QStandardPaths.setTestModeEnabled(True)
+        self.app = QCoreApplication([sys.argv[0]])
+        DBusQtMainLoop(set_as_default=True)
+        self.bus = dbus.SessionBus()
+        self.bus_name = dbus.service.BusName(BUS_NAME, self.bus)
+        self.args = args
+        self.gitter = Gitter('http://127.0.0.1/', max(args.rooms), seed=1)
+        self.emitted = 0
+        self._paths = itertools.count()
+
+    def makeRooms(self, count):
+        rooms = []
+        for json_room in self.gitter.rooms[:count]:
+            room = Room(None, None, json=json_room)
+            sink = ChannelSink(self, room, '/org/glitter/BenchPipeline/{}'.format(
+                next(self._paths)))
+            rooms.append((room, sink))
+        return rooms
+
+    def drain(self, expected):
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while self.emitted < expected:
+            if time.monotonic() > deadline:
+                raise RuntimeError('only {} of {} messages were emitted'.format(
+                    self.emitted, expected))
+            self.app.processEvents(QEventLoop.AllEvents, 10)
+
+    def runPipeline(self, rooms, bursts, size, kind):
+        """Feed bursts of size lines to every room, returning seconds
+        """
+        feeds = [[(room, encode(make_payloads(kind, self.gitter, size)))
+                  for room, sink in rooms]
+                 for _ in range(bursts)]
+        self.emitted = 0
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        for burst in feeds:
+            for room, lines in burst:
+                room.receiveMessageStream(StreamChunk(lines))
+            self.drain(self.emitted + len(burst) * size)
+        return time.perf_counter() - wall, time.process_time() - cpu
+
+    def benchCase(self, room_count, size, kind):
+        rooms = self.makeRooms(room_count)
+        peak_reset = reset_peak_rss()
+        bursts = self.args.bursts
+        total = room_count * size * bursts
+        # a burst to warm up imports and caches
+        self.runPipeline(rooms, 1, size, kind)
+        runs = [self.runPipeline(rooms, bursts, size, kind)
+                for _ in range(self.args.repeat)]
+        wall, cpu = min(runs)
+        result = {
+            'rooms': room_count,
+            'burst': size,
+            'payload': kind,
+            'messages': total,
+            'messages_per_s': total / wall,
+            'cpu_us_per_message': cpu / total * 1e6,
+            'peak_rss_kb': peak_rss_kb(),
+            'peak_rss_per_case': peak_reset,
+        }
+        if self.args.allocations:
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            self.runPipeline(rooms, bursts, size, kind)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result['retained_bytes_per_message'] = (current - before) / total
+            result['alloc_peak_bytes'] = peak - before
+        for room, sink in rooms:
+            sink.remove_from_connection()
+        return result
+
+    def benchStages(self, count, kind):
+        """Time each stage on its own, in us per message
+        """
+        (room, sink), = self.makeRooms(1)
+        records = make_payloads(kind, self.gitter, count)
+        lines = encode(records)
+        decoded = [normalize(codec.loads(line)) for line in lines]
+
+        def timed(func):
+            start = time.perf_counter()
+            func()
+            return (time.perf_counter() - start) / count * 1e6
+
+        stages = {}
+        stages['decode'] = timed(
+            lambda: [normalize(codec.loads(line)) for line in lines])
+        messages = []
+        stages['loadJson'] = timed(
+            lambda: messages.extend(Message(json=r) for r in decoded))
+
+        def store():
+            for message in messages:
+                room.messages[message.id] = message
+        # keep the channel out of this one
+        room.messagesReceived.disconnect(sink._signal_text_received)
+        stages['setitem'] = timed(store)
+
+        def emit():
+            for message in messages:
+                sink._signal_text_received(message.id)
+        stages['signal'] = timed(emit)
+        sink.remove_from_connection()
+        return stages
+
+
+def compare(old, new):
+    """Print how messages per second moved since an earlier results file
+    """
+    key = lambda case: (case['payload'], case['rooms'], case['burst'])
+    before = {key(case): case for case in old['cases']}
+    print('\ncompared with {} ({})'.format(
+        old.get('commit'), old.get('date')))
+    for case in new['cases']:
+        previous = before.get(key(case))
+        if previous:
+            change = case['messages_per_s'] / previous['messages_per_s'] - 1
+            print('{:>10} {:5d} rooms {:5d} burst {:+8.1%}'.format(
+                case['payload'], case['rooms'], case['burst'], change))
+
+
+def main(cmdline=None):
+    parser = make_parser()
+    args = parser.parse_args(cmdline)
+
+    daemon, address = start_bus()
+    os.environ['DBUS_SESSION_BUS_ADDRESS'] = address
+    try:
+        bench = Bench(args)
+        report = {
+            'commit': git_commit(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'json_backend': codec.BACKEND,
+            'payloads': {kind: PAYLOADS[kind] for kind in args.payload},
+            'cases': [],
+            'stages_us_per_message': {},
+        }
+        for kind in args.payload:
+            for room_count in args.rooms:
+                for size in args.burst:
+                    case = bench.benchCase(room_count, size, kind)
+                    report['cases'].append(case)
+                    print('{payload:>10} {rooms:5d} rooms {burst:5d} burst '
+                          '{messages_per_s:10.0f} msg/s '
+                          '{cpu_us_per_message:8.1f} us/msg '
+                          '{peak_rss_kb:8d} KiB'.format(**case))
+            report['stages_us_per_message'][kind] = bench.benchStages(
+                args.stage_messages, kind)
+            print('{:>10} stages: {}'.format(kind, ', '.join(
+                '{} {:.1f}us'.format(name, us) for name, us in
+                sorted(report['stages_us_per_message'][kind].items()))))
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    output = args.output or os.path.join(
+        TOP, 'benchmarks', 'results', 'pipeline-{}-{}.json'.format(
+            report['commit'] or 'unknown', time.strftime('%Y%m%dT%H%M%S')))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as outstream:
+        json.dump(report, outstream, indent=1, sort_keys=True)
+    print('results written to', output)
+
+    if args.compare:
+        with open(args.compare) as instream:
+            compare(json.load(instream), report)
+    return 0
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rooms', type=int, nargs='+', default=[1, 10, 50],
+                        help='room counts to measure')
+    parser.add_argument('--burst', type=int, nargs='+', default=[1, 20, 200],
+                        help='lines arriving in one read, per room')
+    parser.add_argument('--bursts', type=int, default=10,
+                        help='bursts per measured run')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per case, the fastest is kept')
+    parser.add_argument('--payload', nargs='+', default=['fixture', 'random'],
+                        choices=sorted(PAYLOADS),
+                        help='synthetic payload kinds to measure')
+    parser.add_argument('--stage-messages', type=int, default=2000,
+                        help='messages timed per stage')
+    parser.add_argument('--allocations', action='store_true', default=False,
+                        help='add a tracemalloc pass to every case')
+    parser.add_argument('--output', help='results file, defaults to '
+                        'benchmarks/results/pipeline-<commit>-<time>.json')
+    parser.add_argument('--compare', metavar='RESULTS',
+                        help='an earlier results file to compare with')
+    return parser
+
+
+if __name__ == '__main__':
+    sys.exit(main())
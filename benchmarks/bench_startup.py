@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+"""Time connection manager startup on a private session bus
+
+Measures from launching the connection manager until it owns its
+ConnectionManager bus name, which is what D-Bus activation waits on
+during login. Every run gets a fresh dbus-daemon so nothing is cached
+on the bus side.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import dbus
+
+BUS_NAME = 'org.freedesktop.Telepathy.ConnectionManager.glitter'
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def start_bus():
+    daemon = subprocess.Popen(
+        ['dbus-daemon', '--session', '--nofork', '--print-address'],
+        stdout=subprocess.PIPE, universal_newlines=True)
+    address = daemon.stdout.readline().strip()
+    return daemon, address
+
+
+def time_startup(timeout, importtime=False):
+    """Return (seconds until the bus name appeared, -X importtime output)
+    """
+    daemon, address = start_bus()
+    bus = dbus.bus.BusConnection(address)
+    env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS=address)
+    cmd = [sys.executable]
+    if importtime:
+        cmd.extend(['-X', 'importtime'])
+    cmd.append(os.path.join(TOP, 'test'))
+
+    # a file rather than a pipe, so a chatty child can never block on it
+    with tempfile.TemporaryFile(mode='w+') as stderr:
+        start = time.monotonic()
+        proc = subprocess.Popen(cmd, env=env, cwd=TOP,
+                                stdout=subprocess.DEVNULL, stderr=stderr)
+        try:
+            while not bus.name_has_owner(BUS_NAME):
+                if proc.poll() is not None:
+                    raise RuntimeError('connection manager exited with {}'.format(
+                        proc.returncode))
+                if time.monotonic() - start > timeout:
+                    raise RuntimeError('{} did not appear within {}s'.format(
+                        BUS_NAME, timeout))
+                time.sleep(0.001)
+            elapsed = time.monotonic() - start
+        finally:
+            proc.terminate()
+            proc.wait()
+            bus.close()
+            daemon.terminate()
+            daemon.wait()
+        stderr.seek(0)
+        return elapsed, stderr.read()
+
+
+def slowest_imports(output, count):
+    """Return the count modules with the highest self import time in us
+    """
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        imports.append((int(self_us), int(cumulative_us), module.strip()))
+    imports.sort(reverse=True)
+    return imports[:count]
+
+
+def main(cmdline=None):
+    parser = make_parser()
+    args = parser.parse_args(cmdline)
+
+    # the first launch pays for cold disk caches, keep it out of the numbers
+    time_startup(args.timeout)
+    runs = [time_startup(args.timeout)[0] for _ in range(args.repeat)]
+    report = {
+        'runs_ms': [r * 1000 for r in runs],
+        'min_ms': min(runs) * 1000,
+        'median_ms': statistics.median(runs) * 1000,
+    }
+    if args.imports:
+        _, output = time_startup(args.timeout, importtime=True)
+        report['slowest_imports'] = [
+            {'module': module, 'self_us': self_us, 'cumulative_us': cumulative_us}
+            for self_us, cumulative_us, module
+            in slowest_imports(output, args.imports)]
+
+    if args.json:
+        json.dump(report, sys.stdout, indent=1, sort_keys=True)
+        print()
+    else:
+        print('startup: min {min_ms:.1f}ms median {median_ms:.1f}ms'
+              ' over {0} runs'.format(args.repeat, **report))
+        for entry in report.get('slowest_imports', []):
+            print('{self_us:10d}us {cumulative_us:10d}us  {module}'.format(**entry))
+
+    if args.max_ms is not None and report['median_ms'] > args.max_ms:
+        print('median startup {:.1f}ms exceeds {:.1f}ms'.format(
+            report['median_ms'], args.max_ms), file=sys.stderr)
+        return 1
+    return 0
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds to wait for the bus name')
+    parser.add_argument('--imports', type=int, default=0, metavar='N',
+                        help='also list the N slowest imports')
+    parser.add_argument('--max-ms', type=float,
+                        help='exit with an error if the median is slower')
+    parser.add_argument('--json', action='store_true', default=False,
+                        help='print machine readable results')
+    return parser
+
+
+if __name__ == '__main__':
+    sys.exit(main())
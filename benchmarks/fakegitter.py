@@ -0,0 +1,471 @@
+#!/usr/bin/python3
+"""A stand-in for the Gitter api and streaming servers
+
+Serves the parts of the api glitter talks to from the fixtures,
+cloned to as many rooms as asked for:
+
+  GET  /v1/user
+  GET  /v1/rooms
+  GET  /v1/rooms/:id/chatMessages   skip, beforeId, afterId, limit
+  POST /v1/rooms/:id/chatMessages
+  GET  /v1/rooms/:id/users          skip, limit
+  GET  /stream/v1/rooms/:id/chatMessages
+  GET  /stream/v1/rooms/:id/users
+  GET  /avatars/:name
+
+Synthetic traffic can be posted to random rooms at a fixed rate, and
+the server can misbehave on purpose: streams that drop, 429s and slow
+replies. Point glitter at it with the environment it prints:
+
+  GITTER_API=http://127.0.0.1:8899/v1/
+  GITTER_STREAM=http://127.0.0.1:8899/stream/v1/
+
+Any token is accepted.
+"""
+import argparse
+import copy
+import gzip
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+WORDS = ('gitter python telepathy message room build error fix test '
+         'import module version install list return broken use the a of '
+         'on and is it works for me now').split()
+# a 1x1 transparent png
+AVATAR = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010806000000'
+    '1f15c4890000000d49444154789c6360000002000001e221bc33000000'
+    '0049454e44ae426082')
+RATE_LIMIT = 100
+RATE_WINDOW = 60
+
+_ROUTES = [
+    ('GET', re.compile(r'^/v1/user/?$'), 'getUser'),
+    ('GET', re.compile(r'^/v1/rooms/?$'), 'getRooms'),
+    ('GET', re.compile(r'^/v1/rooms/(\w+)/chatMessages$'), 'getMessages'),
+    ('POST', re.compile(r'^/v1/rooms/(\w+)/chatMessages$'), 'postMessage'),
+    ('GET', re.compile(r'^/v1/rooms/(\w+)/users$'), 'getUsers'),
+    ('GET', re.compile(r'^/stream/v1/rooms/(\w+)/chatMessages$'), 'streamMessages'),
+    ('GET', re.compile(r'^/stream/v1/rooms/(\w+)/users$'), 'streamUsers'),
+    ('GET', re.compile(r'^/avatars/([^/]+)$'), 'getAvatar'),
+]
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name + '.json'), 'rb') as instream:
+        return json.loads(instream.read().decode('utf-8'))
+
+
+def timestamp(when):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(when)) + \
+        '.{:03d}Z'.format(int(when * 1000) % 1000)
+
+
+class Gitter(object):
+    """The rooms, messages and members the server hands out
+    """
+    def __init__(self, base_url, rooms=None, history=50, seed=None):
+        self.base_url = base_url
+        self._random = random.Random(seed)
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        # room id -> list of queues, one per open message stream
+        self._listeners = {}
+
+        users = load_fixture('users')
+        for user in users:
+            self._fixAvatars(user)
+        self.users = users
+        self.me = dict(users[0], username='glitter', displayName='Glitter',
+                       id=self.newId())
+        self._fixAvatars(self.me)
+
+        template = load_fixture('rooms')
+        self.rooms = []
+        for i in range(rooms or len(template)):
+            room = copy.deepcopy(template[i % len(template)])
+            if i >= len(template):
+                room['name'] = '{}-{}'.format(room['name'], i)
+                room['url'] = '/' + room['name']
+                room['user'] = dict(room.get('user') or {},
+                                    username=room['name'])
+            room['id'] = self.newId()
+            room['unreadItems'] = room['mentions'] = 0
+            self._fixAvatars(room)
+            self._fixAvatars(room.get('user'))
+            self.rooms.append(room)
+        self.roomsById = {room['id']: room for room in self.rooms}
+
+        sample = load_fixture('chatMessages')
+        self.messages = {}
+        start = time.time() - history
+        for room in self.rooms:
+            self.messages[room['id']] = [
+                self.newMessage(self._random.choice(self.users), m['text'],
+                                start + n)
+                for n, m in enumerate(sample[:history])]
+
+    def _fixAvatars(self, obj):
+        """Serve avatars ourselves so nothing leaves the machine
+        """
+        if not obj:
+            return
+        name = obj.get('username') or obj.get('name') or 'x'
+        for key in ('avatarUrl', 'avatarUrlSmall', 'avatarUrlMedium'):
+            if key in obj:
+                obj[key] = '{}avatars/{}?{}'.format(self.base_url, name, key)
+
+    def newId(self):
+        # object ids start with the creation time, so they sort by age
+        # just like gitter's
+        return '{:08x}{:016x}'.format(int(time.time()), next(self._counter))
+
+    def newMessage(self, user, text, when=None):
+        return {
+            'id': self.newId(),
+            'text': text,
+            'html': '<p>{}</p>'.format(text),
+            'sent': timestamp(when or time.time()),
+            'fromUser': user,
+            'unread': False,
+            'readBy': 0,
+            'urls': [],
+            'mentions': [],
+            'issues': [],
+            'meta': [],
+            'v': 1,
+        }
+
+    def post(self, room_id, text, user=None):
+        message = self.newMessage(user or self.me, text)
+        with self._lock:
+            self.messages[room_id].append(message)
+            listeners = list(self._listeners.get(room_id, ()))
+        for listener in listeners:
+            listener.put(message)
+        return message
+
+    def randomText(self):
+        return ' '.join(self._random.choice(WORDS)
+                        for _ in range(self._random.randint(3, 30)))
+
+    def randomMessage(self):
+        """Return a message from a random member without posting it
+        """
+        return self.newMessage(self._random.choice(self.users),
+                               self.randomText())
+
+    def chatter(self):
+        """Post a random message to a random room
+        """
+        room = self._random.choice(self.rooms)
+        return self.post(room['id'], self.randomText(),
+                         self._random.choice(self.users))
+
+    def page(self, room_id, skip=0, beforeId=None, afterId=None, limit=50):
+        with self._lock:
+            messages = list(self.messages[room_id])
+        if afterId:
+            messages = [m for m in messages if m['id'] > afterId][:limit]
+        else:
+            if beforeId:
+                messages = [m for m in messages if m['id'] < beforeId]
+            end = len(messages) - skip
+            messages = messages[max(0, end - limit):max(0, end)]
+        return messages
+
+    def listen(self, room_id):
+        listener = queue.Queue()
+        with self._lock:
+            self._listeners.setdefault(room_id, []).append(listener)
+        return listener
+
+    def unlisten(self, room_id, listener):
+        with self._lock:
+            self._listeners[room_id].remove(listener)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def gitter(self):
+        return self.server.gitter
+
+    @property
+    def options(self):
+        return self.server.options
+
+    def log_message(self, format, *args):
+        if self.options.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+    def route(self, method):
+        url = urlsplit(self.path)
+        self.query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        for route_method, pattern, name in _ROUTES:
+            match = pattern.match(url.path)
+            if match and route_method == method:
+                if not name.startswith('stream') and self.misbehave():
+                    return
+                getattr(self, name)(*match.groups())
+                return
+        self.sendJson({'error': 'Not Found'}, 404)
+
+    def misbehave(self):
+        """Answer 429 or slow down as configured, True if already answered
+        """
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            count = server.requests
+            now = time.time()
+            if now >= server.window_reset:
+                server.window_reset = now + RATE_WINDOW
+                server.window_used = 0
+            server.window_used += 1
+        if self.options.rate_limit_every and \
+                count % self.options.rate_limit_every == 0:
+            body = b'{"error":"Too Many Requests"}'
+            self.send_response(429)
+            self.send_header('Retry-After', str(self.options.retry_after))
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return True
+        if self.options.slow_fraction and \
+                random.random() < self.options.slow_fraction:
+            time.sleep(self.options.slow_ms / 1000)
+        return False
+
+    def readBody(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+
+    def sendJson(self, obj, status=200):
+        body = json.dumps(obj).encode('utf-8')
+        gzipped = (not self.options.no_gzip and
+                   'gzip' in self.headers.get('Accept-Encoding', ''))
+        if gzipped:
+            body = gzip.compress(body)
+        server = self.server
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('X-RateLimit-Limit', str(RATE_LIMIT))
+        self.send_header('X-RateLimit-Remaining',
+                         str(max(0, RATE_LIMIT - server.window_used)))
+        self.send_header('X-RateLimit-Reset', str(int(server.window_reset * 1000)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def room(self, room_id):
+        if room_id not in self.gitter.roomsById:
+            self.sendJson({'error': 'Not Found'}, 404)
+            return False
+        return True
+
+    def getUser(self):
+        self.sendJson([self.gitter.me])
+
+    def getRooms(self):
+        self.sendJson(self.gitter.rooms)
+
+    def getMessages(self, room_id):
+        if self.room(room_id):
+            self.sendJson(self.gitter.page(
+                room_id,
+                skip=int(self.query.get('skip', 0)),
+                beforeId=self.query.get('beforeId'),
+                afterId=self.query.get('afterId'),
+                limit=min(100, int(self.query.get('limit', 50)))))
+
+    def postMessage(self, room_id):
+        if self.room(room_id):
+            text = self.readBody().get('text')
+            if not text:
+                self.sendJson({'error': 'Message text required'}, 400)
+            else:
+                self.sendJson(self.gitter.post(room_id, text))
+
+    def getUsers(self, room_id):
+        if self.room(room_id):
+            skip = int(self.query.get('skip', 0))
+            limit = int(self.query.get('limit', 30))
+            self.sendJson(self.gitter.users[skip:skip + limit])
+
+    def getAvatar(self, name):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(AVATAR)))
+        self.send_header('Cache-Control', 'max-age=86400')
+        self.end_headers()
+        self.wfile.write(AVATAR)
+
+    def startStream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+    def writeChunk(self, data):
+        self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') +
+                         data + b'\r\n')
+        self.wfile.flush()
+
+    def stream(self, room_id, listener):
+        """Write events from listener as lines, with heartbeats in between
+        """
+        options = self.options
+        deadline = (time.time() + options.disconnect_after
+                    if options.disconnect_after else None)
+        next_beat = time.time() + options.heartbeat
+        self.startStream()
+        try:
+            while deadline is None or time.time() < deadline:
+                timeout = next_beat - time.time()
+                if deadline is not None:
+                    timeout = min(timeout, deadline - time.time())
+                try:
+                    event = listener.get(timeout=max(0, timeout))
+                except queue.Empty:
+                    if time.time() >= next_beat:
+                        self.writeChunk(b' \n')
+                        next_beat = time.time() + options.heartbeat
+                    continue
+                self.writeChunk(json.dumps(event).encode('utf-8') + b'\n')
+            # the last chunk, as a server closing the stream would send
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        self.close_connection = True
+
+    def streamMessages(self, room_id):
+        if self.room(room_id):
+            listener = self.gitter.listen(room_id)
+            try:
+                self.stream(room_id, listener)
+            finally:
+                self.gitter.unlisten(room_id, listener)
+
+    def streamUsers(self, room_id):
+        # membership never changes here, so it is only heartbeats
+        if self.room(room_id):
+            self.stream(room_id, queue.Queue())
+
+
+class FakeGitterServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, options):
+        super().__init__(address, Handler)
+        self.options = options
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.window_used = 0
+        self.window_reset = time.time() + RATE_WINDOW
+        host, port = self.server_address[:2]
+        self.base_url = 'http://{}:{}/'.format(host, port)
+        self.gitter = Gitter(self.base_url, options.rooms, options.history,
+                             options.seed)
+
+    @property
+    def environment(self):
+        return {'GITTER_API': self.base_url + 'v1/',
+                'GITTER_STREAM': self.base_url + 'stream/v1/'}
+
+    def startTraffic(self, rate):
+        """Post rate messages a second to random rooms until shutdown
+        """
+        def run():
+            interval = 1 / rate
+            due = time.time()
+            while not self._stopping.is_set():
+                due += interval
+                self.gitter.chatter()
+                delay = due - time.time()
+                if delay > 0:
+                    self._stopping.wait(delay)
+        self._stopping = threading.Event()
+        thread = threading.Thread(target=run, name='fakegitter-traffic',
+                                  daemon=True)
+        thread.start()
+
+    def server_close(self):
+        if hasattr(self, '_stopping'):
+            self._stopping.set()
+        super().server_close()
+
+
+def main(cmdline=None):
+    parser = make_parser()
+    args = parser.parse_args(cmdline)
+
+    server = FakeGitterServer((args.host, args.port), args)
+    if args.rate:
+        server.startTraffic(args.rate)
+    for name, value in sorted(server.environment.items()):
+        print('{}={}'.format(name, value))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8899,
+                        help='0 picks a free port')
+    parser.add_argument('--rooms', type=int, default=0,
+                        help='rooms to serve, defaults to those in the fixture')
+    parser.add_argument('--history', type=int, default=50,
+                        help='messages already in each room')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='synthetic messages per second, across all rooms')
+    parser.add_argument('--heartbeat', type=float, default=30,
+                        help='seconds between stream heartbeats')
+    parser.add_argument('--disconnect-after', type=float, default=0,
+                        help='end streams after this many seconds')
+    parser.add_argument('--rate-limit-every', type=int, default=0,
+                        help='answer every Nth api request with a 429')
+    parser.add_argument('--retry-after', type=int, default=1,
+                        help='Retry-After seconds sent with a 429')
+    parser.add_argument('--slow-fraction', type=float, default=0,
+                        help='fraction of api requests to delay')
+    parser.add_argument('--slow-ms', type=int, default=2000,
+                        help='how long a slow request is delayed')
+    parser.add_argument('--no-gzip', action='store_true', default=False,
+                        help="don't compress api replies")
+    parser.add_argument('--seed', type=int, help='random seed')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False,
+                        help='log every request')
+    return parser
+
+
+if __name__ == '__main__':
+    main()
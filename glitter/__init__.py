@@ -1 +1,10 @@
-from glitter.connection_manager import *
+__all__ = ['GlitterConnectionManager']
+
+
+def __getattr__(name):
+    # importing the connection manager pulls in dbus and telepathy,
+    # so only do it for callers that ask for it
+    if name == 'GlitterConnectionManager':
+        from glitter.connection_manager import GlitterConnectionManager
+        return GlitterConnectionManager
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
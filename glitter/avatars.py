@@ -0,0 +1,312 @@
+# telepathy-glitter - an Gitter connection manager for Telepathy
+#
+# Copyright (C) 2015 Diane Trout
+#
+# Based on telepathy-butterfly
+#
+# Copyright (C) 2006-2007 Ali Sabil <ali.sabil@gmail.com>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import collections
+import hashlib
+import logging
+import os
+
+import dbus
+import telepathy
+
+from PyQt5.QtCore import QObject, QUrl, pyqtSignal
+from PyQt5.QtNetwork import QNetworkRequest
+
+from glitter.util.storage import cache_dir, read_json, write_json, write_atomic
+
+__all__ = ['GlitterAvatars', 'AvatarCache']
+
+logger = logging.getLogger('Glitter.Avatars')
+
+AVATAR_MIME_TYPES = ['image/png', 'image/jpeg', 'image/gif']
+
+# Keep this well under the per host connection limit of
+# QNetworkAccessManager so avatars never starve the API requests
+MAX_CONCURRENT_FETCHES = 4
+
+
+class AvatarCache(QObject):
+    """Content addressed avatar store
+
+    Images are written once, named by the sha1 of their bytes, which
+    is also the telepathy avatar token. The index maps an avatar url
+    to its token and the validators needed to revalidate it. Gitter
+    puts a version in its avatar urls, so a new avatar is a new url.
+    Fetches share the connection's network manager and at most
+    max_concurrent of them run at once.
+    """
+    def __init__(self, net, max_concurrent=MAX_CONCURRENT_FETCHES):
+        super().__init__()
+        self._net = net
+        self._max_concurrent = max_concurrent
+        self._directory = cache_dir('avatars')
+        self._index_filename = os.path.join(self._directory, 'index.json')
+        # keys used to carry the room version after a '#'
+        self._index = {url: entry for url, entry in
+                       read_json(self._index_filename, {}).items()
+                       if '#' not in url}
+        self._mime_types = {entry['token']: entry['mime']
+                            for entry in self._index.values()}
+        # keys checked against the server during this session
+        self._validated = set()
+        self._pending = collections.OrderedDict()
+        self._active = {}
+        self._dirty = False
+
+    # url, token
+    avatarChanged = pyqtSignal(str, str)
+
+    def token(self, url):
+        """Return the cached token for url, or None if it isn't known yet
+
+        Anything not yet checked this session is queued for a fetch or
+        revalidation, the cached token is returned regardless.
+        """
+        if url not in self._validated:
+            self.fetch(url)
+        entry = self._index.get(url)
+        if entry:
+            return entry['token']
+
+    def data(self, token):
+        """Return (image bytes, mime type) for a token, or None
+        """
+        try:
+            with open(self._filename(token), 'rb') as instream:
+                return instream.read(), self._mime_types.get(token, '')
+        except FileNotFoundError:
+            self._forget(token)
+
+    def fetch(self, url):
+        if url in self._active or url in self._pending:
+            return
+        self._pending[url] = url
+        self._startFetches()
+
+    def discard(self, url):
+        """Forget a url nothing shows any more, and its image if unshared
+        """
+        self._pending.pop(url, None)
+        self._validated.discard(url)
+        reply = self._active.pop(url, None)
+        if reply is not None:
+            reply.finished.disconnect()
+            reply.abort()
+            reply.deleteLater()
+        entry = self._index.pop(url, None)
+        if entry is not None:
+            self._dirty = True
+            token = entry['token']
+            if not any(v['token'] == token for v in self._index.values()):
+                self._mime_types.pop(token, None)
+                try:
+                    os.unlink(self._filename(token))
+                except FileNotFoundError:
+                    pass
+        self._startFetches()
+
+    def _filename(self, token):
+        return os.path.join(self._directory, token)
+
+    def _forget(self, token):
+        """Drop index entries whose image has gone missing from disk
+        """
+        for key in [k for k, v in self._index.items() if v['token'] == token]:
+            del self._index[key]
+            self._validated.discard(key)
+        self._mime_types.pop(token, None)
+        self._dirty = True
+
+    def _startFetches(self):
+        while self._pending and len(self._active) < self._max_concurrent:
+            key, url = self._pending.popitem(last=False)
+            req = QNetworkRequest(QUrl(url))
+            req.setAttribute(QNetworkRequest.FollowRedirectsAttribute, True)
+            entry = self._index.get(key)
+            if entry:
+                if entry.get('etag'):
+                    req.setRawHeader(b'If-None-Match',
+                                     entry['etag'].encode('utf-8'))
+                if entry.get('last-modified'):
+                    req.setRawHeader(b'If-Modified-Since',
+                                     entry['last-modified'].encode('utf-8'))
+            reply = self._net.get(req)
+            self._active[key] = reply
+            reply.finished.connect(
+                lambda key=key, reply=reply: self._readReply(key, reply))
+
+        if not self._active and not self._pending and self._dirty:
+            self._saveIndex()
+
+    def _readReply(self, key, reply):
+        del self._active[key]
+        self._validated.add(key)
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if reply.error() != 0:
+            logger.warning("Unable to fetch avatar %s: %s",
+                           key, reply.errorString())
+        elif status == 304:
+            logger.debug("Avatar %s not modified", key)
+        else:
+            self._store(key, reply)
+        reply.deleteLater()
+        self._startFetches()
+
+    def _store(self, key, reply):
+        data = bytes(reply.readAll())
+        token = hashlib.sha1(data).hexdigest()
+        filename = self._filename(token)
+        if not os.path.exists(filename):
+            write_atomic(filename, data)
+
+        mime = reply.header(QNetworkRequest.ContentTypeHeader) or ''
+        old = self._index.get(key)
+        self._index[key] = {
+            'token': token,
+            'mime': mime,
+            'etag': bytes(reply.rawHeader(b'ETag')).decode('utf-8'),
+            'last-modified':
+                bytes(reply.rawHeader(b'Last-Modified')).decode('utf-8'),
+        }
+        self._mime_types[token] = mime
+        self._dirty = True
+        if old is None or old['token'] != token:
+            self.avatarChanged.emit(key, token)
+
+    def _saveIndex(self):
+        logger.debug("saving avatar index: %d entries", len(self._index))
+        write_json(self._index_filename, self._index)
+        self._dirty = False
+
+
+class GlitterAvatars(telepathy.server.ConnectionInterfaceAvatars):
+    """Serve room avatars from the AvatarCache
+
+    Tokens are answered straight from the cache, contacts whose
+    avatars were not known are signalled with AvatarUpdated once
+    the fetch completes.
+    """
+    def __init__(self):
+        telepathy.server.ConnectionInterfaceAvatars.__init__(self)
+        self._avatar_cache = None
+        # avatar url -> handles showing that avatar
+        self._avatar_handles = collections.defaultdict(set)
+        # handle -> the url and token it was last given
+        self._avatar_urls = {}
+        self._avatar_tokens = {}
+        # handles waiting on RequestAvatars
+        self._avatar_requests = set()
+
+        self._implement_property_get(
+            telepathy.CONNECTION_INTERFACE_AVATARS,
+            {'SupportedAvatarMIMETypes':
+             lambda: dbus.Array(AVATAR_MIME_TYPES, signature='s'),
+             'MinimumAvatarHeight': lambda: dbus.UInt32(0),
+             'MinimumAvatarWidth': lambda: dbus.UInt32(0),
+             'RecommendedAvatarHeight': lambda: dbus.UInt32(0),
+             'RecommendedAvatarWidth': lambda: dbus.UInt32(0),
+             'MaximumAvatarHeight': lambda: dbus.UInt32(0),
+             'MaximumAvatarWidth': lambda: dbus.UInt32(0),
+             'MaximumAvatarBytes': lambda: dbus.UInt32(0),
+            })
+
+    @property
+    def avatar_cache(self):
+        if self._avatar_cache is None:
+            self._avatar_cache = AvatarCache(self._gitter_client.network)
+            self._avatar_cache.avatarChanged.connect(self._avatar_changed)
+        return self._avatar_cache
+
+    def _avatar_source(self, handle):
+        """Return the avatar url of a contact, '' for none or None for unknown contacts
+        """
+        room = self.roomFromHandle(handle)
+        if room is not None:
+            return room.preferredAvatarUrl or ''
+
+    def _watch_avatar(self, handle, url):
+        """Follow url for handle, dropping the url it showed before
+        """
+        old = self._avatar_urls.get(handle)
+        if old == url:
+            return
+        if old:
+            handles = self._avatar_handles[old]
+            handles.discard(handle)
+            if not handles:
+                del self._avatar_handles[old]
+                self.avatar_cache.discard(old)
+        if url:
+            self._avatar_urls[handle] = url
+            self._avatar_handles[url].add(handle)
+        else:
+            self._avatar_urls.pop(handle, None)
+
+    def _avatar_changed(self, url, token):
+        handles = self._avatar_handles.get(url, ())
+        for handle in handles:
+            if self._avatar_tokens.get(handle) != token:
+                self._avatar_tokens[handle] = token
+                self.AvatarUpdated(handle, token)
+            if handle in self._avatar_requests:
+                self._avatar_requests.discard(handle)
+                self._retrieve_avatar(handle, token)
+
+    def _retrieve_avatar(self, handle, token):
+        result = self.avatar_cache.data(token)
+        if result is not None:
+            data, mime = result
+            self.AvatarRetrieved(handle, token, dbus.ByteArray(data), mime)
+
+    def GetAvatarRequirements(self):
+        return (AVATAR_MIME_TYPES, 0, 0, 0, 0, 0)
+
+    def GetAvatarTokens(self, contacts):
+        tokens = self.GetKnownAvatarTokens(contacts)
+        return [tokens.get(handle, '') for handle in contacts]
+
+    def GetKnownAvatarTokens(self, contacts):
+        ret = dbus.Dictionary(signature='us')
+        for handle in contacts:
+            url = self._avatar_source(handle)
+            if url is None:
+                continue
+            self._watch_avatar(int(handle), url)
+            if not url:
+                # we know this contact has no avatar
+                self._avatar_tokens[int(handle)] = ''
+                ret[handle] = ''
+                continue
+            token = self.avatar_cache.token(url)
+            if token is not None:
+                self._avatar_tokens[int(handle)] = token
+                ret[handle] = token
+        return ret
+
+    def RequestAvatars(self, contacts):
+        tokens = self.GetKnownAvatarTokens(contacts)
+        for handle in contacts:
+            token = tokens.get(handle)
+            if token:
+                self._retrieve_avatar(handle, token)
+            elif token is None:
+                self._avatar_requests.add(int(handle))
@@ -21,197 +21,103 @@ import dbus
 
 import telepathy
 
-from glitter.util.decorator import async
+from glitter.util.decorator import asynchronous
 
 __all__ = ['GlitterCapabilities']
 
 logger = logging.getLogger('Glitter.Capabilities')
 
+# Every Gitter contact is a room we can chat in and nothing else, so
+# the capabilities are built once and shared by all handles. These
+# values are never modified after import.
+
+# Capabilities interface: channel type -> [generic flags, specific flags]
+DEFAULT_CAPABILITIES = {
+    telepathy.CHANNEL_TYPE_TEXT:
+        [telepathy.CONNECTION_CAPABILITY_FLAG_CREATE, 0],
+}
+
+# (channel type, old generic, new generic, old specific, new specific)
+# for a contact going from no capabilities to DEFAULT_CAPABILITIES
+DEFAULT_CAPABILITY_CHANGES = tuple(
+    (ctype, 0, generic, 0, specific)
+    for ctype, (generic, specific) in DEFAULT_CAPABILITIES.items())
+
+TEXT_CHAT_CLASS = dbus.Struct(
+    (dbus.Dictionary(
+        {telepathy.CHANNEL_INTERFACE + '.ChannelType':
+             dbus.String(telepathy.CHANNEL_TYPE_TEXT),
+         telepathy.CHANNEL_INTERFACE + '.TargetHandleType':
+             dbus.UInt32(telepathy.HANDLE_TYPE_CONTACT)},
+        signature='sv'),
+     dbus.Array(
+        [telepathy.CHANNEL_INTERFACE + '.TargetHandle',
+         telepathy.CHANNEL_INTERFACE + '.TargetID'],
+        signature='s')),
+    signature='a{sv}as')
+
+CONTACT_CAPABILITIES = dbus.Array([TEXT_CHAT_CLASS], signature='(a{sv}as)')
+
+
 class GlitterCapabilities(
         telepathy.server.ConnectionInterfaceCapabilities,
         telepathy.server.ConnectionInterfaceContactCapabilities,
 ):
 
-    text_chat_class = \
-        ({telepathy.CHANNEL_INTERFACE + '.ChannelType':
-              telepathy.CHANNEL_TYPE_TEXT,
-          telepathy.CHANNEL_INTERFACE + '.TargetHandleType':
-              dbus.UInt32(telepathy.HANDLE_TYPE_CONTACT)},
-         [telepathy.CHANNEL_INTERFACE + '.TargetHandle',
-          telepathy.CHANNEL_INTERFACE + '.TargetID'])
-
-    audio_chat_class = \
-        ({telepathy.CHANNEL_INTERFACE + '.ChannelType':
-              telepathy.CHANNEL_TYPE_STREAMED_MEDIA,
-          telepathy.CHANNEL_INTERFACE + '.TargetHandleType':
-              dbus.UInt32(telepathy.HANDLE_TYPE_CONTACT)},
-         [telepathy.CHANNEL_INTERFACE + '.TargetHandle',
-          telepathy.CHANNEL_INTERFACE + '.TargetID',
-          telepathy.CHANNEL_TYPE_STREAMED_MEDIA + '.InitialAudio'])
-
-    av_chat_class = \
-        ({telepathy.CHANNEL_INTERFACE + '.ChannelType':
-              telepathy.CHANNEL_TYPE_STREAMED_MEDIA,
-          telepathy.CHANNEL_INTERFACE + '.TargetHandleType':
-              dbus.UInt32(telepathy.HANDLE_TYPE_CONTACT)},
-         [telepathy.CHANNEL_INTERFACE + '.TargetHandle',
-          telepathy.CHANNEL_INTERFACE + '.TargetID',
-          telepathy.CHANNEL_TYPE_STREAMED_MEDIA + '.InitialAudio',
-          telepathy.CHANNEL_TYPE_STREAMED_MEDIA + '.InitialVideo'])
-
-    file_transfer_class = \
-        ({telepathy.CHANNEL_INTERFACE + '.ChannelType':
-              telepathy.CHANNEL_TYPE_FILE_TRANSFER,
-          telepathy.CHANNEL_INTERFACE + '.TargetHandleType':
-              dbus.UInt32(telepathy.HANDLE_TYPE_CONTACT)},
-         [telepathy.CHANNEL_INTERFACE + '.TargetHandle',
-          telepathy.CHANNEL_INTERFACE + '.TargetID',
-          telepathy.CHANNEL_TYPE_FILE_TRANSFER + '.Requested',
-          telepathy.CHANNEL_TYPE_FILE_TRANSFER + '.Filename',
-          telepathy.CHANNEL_TYPE_FILE_TRANSFER + '.Size',
-          telepathy.CHANNEL_TYPE_FILE_TRANSFER + '.ContentType'])
-
-
     def __init__(self):
         telepathy.server.ConnectionInterfaceCapabilities.__init__(self)
         telepathy.server.ConnectionInterfaceContactCapabilities.__init__(self)
 
-        self._video_clients = []
-        self._update_capabilities_calls = []
-
-
-    ### Events handling ------------------------------------------------------
-
-    # papyon.event.ContactEventInterface
-    def on_contact_client_capabilities_changed(self, contact):
-        handle = self.ensure_contact_handle(contact)
-        if handle == self._self_handle:
-            return # don't update our own capabilities using server ones
-        self._update_capabilities(handle)
-        self._update_contact_capabilities([handle])
-
-    # papyon.event.AddressBookEventInterface
-    def on_addressbook_contact_added(self, contact):
-        """When we add a contact in our contact list, add the
-        default capabilities to the contact"""
-        handle = self.ensure_contact_handle(contact)
-        self._add_default_capabilities([handle])
-        self._update_contact_capabilities([handle])
+        # client name -> channel classes it handles
+        self._client_capabilities = {}
 
 
     ### Capabilities interface -----------------------------------------------
 
-    def _get_capabilities(self, contact):
-        gen_caps = 0
-        spec_caps = 0
-        caps = contact.client_capabilities
-
-        if caps.supports_sip_invite:
-            gen_caps |= telepathy.CONNECTION_CAPABILITY_FLAG_CREATE
-            gen_caps |= telepathy.CONNECTION_CAPABILITY_FLAG_INVITE
-            spec_caps |= telepathy.CHANNEL_MEDIA_CAPABILITY_AUDIO
-            spec_caps |= telepathy.CHANNEL_MEDIA_CAPABILITY_NAT_TRAVERSAL_STUN
-            if caps.has_webcam:
-                spec_caps |= telepathy.CHANNEL_MEDIA_CAPABILITY_VIDEO
-
-        return gen_caps, spec_caps
-
     def _add_default_capabilities(self, handles):
         """Add the default capabilities to these contacts."""
-        ret = []
+        changes = []
         for handle in handles:
-            new_flag = telepathy.CONNECTION_CAPABILITY_FLAG_CREATE
-
-            ctype = telepathy.CHANNEL_TYPE_TEXT
-            diff = self._diff_capabilities(handle, ctype, added_gen=new_flag)
-            ret.append(diff)
-
-            ctype = telepathy.CHANNEL_TYPE_FILE_TRANSFER
-            diff = self._diff_capabilities(handle, ctype, added_gen=new_flag)
-            ret.append(diff)
-
-        self.CapabilitiesChanged(ret)
-
-    def _update_capabilities(self, handle):
-        ctype = telepathy.CHANNEL_TYPE_STREAMED_MEDIA
-
-        new_gen, new_spec = self._get_capabilities(handle.contact)
-        diff = self._diff_capabilities(handle, ctype, new_gen, new_spec)
-        if diff is not None:
-            self.CapabilitiesChanged([diff])
+            handle = int(handle)
+            if handle in self._caps:
+                continue
+            if handle == int(self._self_handle):
+                # AdvertiseCapabilities edits our own table in place
+                self._caps[handle] = {ctype: list(specs) for ctype, specs
+                                      in DEFAULT_CAPABILITIES.items()}
+            else:
+                self._caps[handle] = DEFAULT_CAPABILITIES
+            changes.extend((handle,) + change
+                           for change in DEFAULT_CAPABILITY_CHANGES)
+
+        if changes:
+            self.CapabilitiesChanged(
+                dbus.Array(changes, signature='(usuuuu)'))
 
 
     ### ContactCapabilities interface ----------------------------------------
 
-    def AdvertiseCapabilities(self, add, remove):
-        #for caps, specs in add:
-        #    if caps == telepathy.CHANNEL_TYPE_STREAMED_MEDIA:
-        #        if specs & telepathy.CHANNEL_MEDIA_CAPABILITY_VIDEO:
-        #            self._msn_client.profile.client_id.has_webcam = True
-        #            self._msn_client.profile.client_id.supports_rtc_video = True
-        #for caps in remove:
-        #    if caps == telepathy.CHANNEL_TYPE_STREAMED_MEDIA:
-        #        self._msn_client.profile.client_id.has_webcam = False
-
-        return telepathy.server.ConnectionInterfaceCapabilities.\
-            AdvertiseCapabilities(self, add, remove)
-
     def UpdateCapabilities(self, caps):
-        if self._status != telepathy.CONNECTION_STATUS_CONNECTED:
-            self._update_capabilities_calls.append(caps)
-            return
+        """Remember which channel classes each client handles
 
-        # We only care about voip.
+        Gitter only offers text chat, so nothing a client can handle
+        changes what we advertise and there is nothing to signal.
+        """
         for client, classes, capabilities in caps:
-            video = False
-            for channel_class in classes:
-                # Does this client support video?
-                if channel_class[telepathy.CHANNEL_INTERFACE + '.ChannelType'] == \
-                        telepathy.CHANNEL_TYPE_STREAMED_MEDIA:
-                    video = True
-                    break
-
-            if video and client not in self._video_clients:
-                self._video_clients.append(client)
-            elif not video and client in self._video_clients:
-                # *Did* it used to support video?
-                self._video_clients.remove(client)
-
-        video = (len(self._video_clients) > 0)
-        changed = False
-
-        # We've got no more clients that support video; remove the cap.
-        if not video and not self._video_clients:
-            self._msn_client.profile.client_id.has_webcam = False
-            changed = True
-
-        # We want video.
-        #if video and (not self._msn_client.profile.client_id.has_webcam or
-        #   not self._msn_client.profile.client_id.supports_rtc_video):
-        #    self._msn_client.profile.client_id.has_webcam = True
-        #    self._msn_client.profile.client_id.supports_rtc_video = True
-        #    changed = True
-
-        # Signal.
-        if changed:
-            updated = dbus.Dictionary({self._self_handle: self._contact_caps[self._self_handle]},
-                signature='ua(a{sv}as)')
-            self.ContactCapabilitiesChanged(updated)
-
-    def _get_contact_capabilities(self, contact):
-        contact_caps = []
-
-        contact_caps.append(self.text_chat_class)
-
-        return contact_caps
+            if classes:
+                self._client_capabilities[client] = classes
+            else:
+                self._client_capabilities.pop(client, None)
 
     def _update_contact_capabilities(self, handles):
-        caps = {}
+        caps = dbus.Dictionary(signature='ua(a{sv}as)')
         for handle in handles:
-            caps[handle] = self._get_contact_capabilities(handle)
-            self._contact_caps[handle] = caps[handle] # update global dict
-        ret = dbus.Dictionary(caps, signature='ua(a{sv}as)')
-        self.ContactCapabilitiesChanged(ret)
+            handle = int(handle)
+            if self._contact_caps.get(handle) is not CONTACT_CAPABILITIES:
+                self._contact_caps[handle] = CONTACT_CAPABILITIES
+                caps[handle] = CONTACT_CAPABILITIES
+        if caps:
+            self.ContactCapabilitiesChanged(caps)
 
 
     ### Start ContactCapabilities
@@ -220,38 +126,22 @@ class GlitterCapabilities(
         in_signature="au",
         out_signature="a{ua(a{sv}as)}")
     def GetContactCapabilities(self, handles):
-        logger.debug("GetContactCapabilities: (in) %s", str(handles))
-        handles = set(handles)
-        if 0 in handles:
-            handles.remove(0)
-
-        ret = dbus.Dictionary(signature="u(a{sv}as)")
-        channels = dbus.Dictionary(signature="sv")
-        channels['org.freedesktop.Telepathy.Channel.TargetHandleType'] = telepathy.HANDLE_TYPE_CONTACT
-        channels['org.freedesktop.Telepathy.Channel.ChannelType'] = \
-             'org.freedesktop.Telepathy.Channel.Type.Text'
-        interfaces = dbus.Array(['org.freedesktop.Telepathy.Channel.TargetHandle'], signature="s")
-        struct = dbus.Struct((channels, interfaces), signature="(a{sv}as)")
+        logger.debug("GetContactCapabilities: (in) %d handles", len(handles))
+        ret = dbus.Dictionary(signature="ua(a{sv}as)")
         for h in handles:
-            ret[int(h)] = dbus.Array([struct,], signature="(a{sv}as)")   # (channels, interfaces)
-
+            if h != 0:
+                ret[int(h)] = CONTACT_CAPABILITIES
         return ret
     ### End ContactCapabilities
 
 
     ### Initialization -------------------------------------------------------
 
-    @async
+    @asynchronous
     def _populate_capabilities(self):
         """ Add the default capabilities to all contacts in our
         contacts list."""
-        handles = set([self._self_handle])
-        for contact in self._contact_handles:
-            handles.add(contact)
+        handles = [int(self._self_handle)]
+        handles.extend(self._contact_handles)
         self._add_default_capabilities(handles)
         self._update_contact_capabilities(handles)
-
-        # These caps were updated before we were online.
-        for caps in self._update_capabilities_calls:
-            self.UpdateCapabilities(caps)
-        self._update_capabilities_calls = []
@@ -20,9 +20,10 @@
 
 import logging
 
+import dbus
 import telepathy
 
-from glitter.util.decorator import async
+from glitter.util.decorator import asynchronous
 from glitter.channel.text import GlitterTextChannel
 
 __all__ = ['GlitterMucChannel']
@@ -33,10 +34,17 @@ logger = logging.getLogger('Glitter.MucChannel')
 class GlitterMucChannel(
         GlitterTextChannel,
         telepathy.server.ChannelInterfaceGroup):
+    """Text channel for a Gitter room with many members
+
+    Large rooms have tens of thousands of members, so the roster is
+    only fetched once a client asks for the members. It then arrives
+    one page at a time, each page signalled with its own MembersChanged.
+    """
 
     def __init__(self, conn, manager, room, props, object_path=None):
         GlitterTextChannel.__init__(self, conn, manager, room, props, object_path)
         telepathy.server.ChannelInterfaceGroup.__init__(self)
+        self._members_requested = False
 
         self.GroupFlagsChanged(
             telepathy.CHANNEL_GROUP_FLAG_CHANNEL_SPECIFIC_HANDLES |
@@ -44,6 +52,10 @@ class GlitterMucChannel(
             0
         )
 
+        self._implement_property_get(telepathy.CHANNEL_INTERFACE_GROUP, {
+            'Members': lambda: dbus.Array(self.GetMembers(), signature='u'),
+        })
+
         # This is done in an idle so that classes which subclass this one
         # can do stuff in their __init__ but will still benefit from this method
         # being called.
@@ -51,42 +63,75 @@ class GlitterMucChannel(
 
     def RemoveMembers(self, contacts, message):
         # Group interface, only removing ourself is supported
-        if int(self._conn.self_handle) in contacts:
+        if int(self._conn.GetSelfHandle()) in contacts:
             self.Close()
         else:
             raise telepathy.PermissionDenied()
 
-    def on_room_user_joined(self, contact):
-        handle = self._conn.ensure_contact_handle(contact)
+    def Close(self):
+        if self._members_requested:
+            self._room.usersLoaded.disconnect(self.on_room_users_loaded)
+            self._room.userJoined.disconnect(self.on_room_user_joined)
+            self._room.userLeft.disconnect(self.on_room_user_left)
+            self._conn.forgetMemberHandles(self._members)
+        GlitterTextChannel.Close(self)
+
+    def AddMembers(self, contacts, message):
+        raise telepathy.PermissionDenied("We can't add members")
+
+    def GetMembers(self):
+        self._load_members()
+        return telepathy.server.ChannelInterfaceGroup.GetMembers(self)
+
+    def GetAllMembers(self):
+        self._load_members()
+        return telepathy.server.ChannelInterfaceGroup.GetAllMembers(self)
+
+    def _load_members(self):
+        """Start streaming the room roster the first time it is wanted
+        """
+        if self._members_requested or self._room is None:
+            return
+        self._members_requested = True
+        self._room.usersLoaded.connect(self.on_room_users_loaded)
+        self._room.userJoined.connect(self.on_room_user_joined)
+        self._room.userLeft.connect(self.on_room_user_left)
+        self._room.startUserStream()
+        self._room.loadUsers()
+
+    def on_room_users_loaded(self, users, more):
+        names = [user['username'] for user in users]
+        # FIXME: This sender is a hack to make a room specific handle
+        handles = self._conn.ensureMemberHandles(names, sender=self._object_path)
+        added = [h for h in handles if h not in self._members]
+        logger.debug("%s: %d members loaded", self._room, len(added))
+        if added:
+            self.MembersChanged('', added, [], [], [],
+                    0, telepathy.CHANNEL_GROUP_CHANGE_REASON_NONE)
+        if more:
+            self._room.loadUsers()
+
+    def on_room_user_joined(self, user):
+        handle, = self._conn.ensureMemberHandles(
+            [user['username']], sender=self._object_path)
         logger.info("User %s joined" % str(handle))
 
         if handle not in self._members:
             self.MembersChanged(
                 '', [handle], [], [], [],
-                handle, telepathy.CHANNEL_GROUP_CHANGE_REASON_INVITED)
+                handle, telepathy.CHANNEL_GROUP_CHANGE_REASON_NONE)
 
-    def on_room_user_left(self, contact):
-        handle = self._conn.ensure_contact_handle(contact)
+    def on_room_user_left(self, user):
+        handle, = self._conn.ensureMemberHandles(
+            [user['username']], sender=self._object_path)
         logger.info("User %s left" % str(handle))
 
-        self.MembersChanged(
-            '', [], [handle], [], [],
-            handle, telepathy.CHANNEL_GROUP_CHANGE_REASON_NONE)
-
-    def AddMembers(self, contacts, message):
-        raise telepathy.PermissionDenied("We can't add members")
+        if handle in self._members:
+            self.MembersChanged(
+                '', [], [handle], [], [],
+                handle, telepathy.CHANNEL_GROUP_CHANGE_REASON_NONE)
 
-    @async
+    @asynchronous
     def __add_initial_participants(self):
-        handles = []
-        handles.append(self._conn.self_handle)
-        if self._room:
-            for user in self._room.users:
-                name = user['username']
-                # FIXME: This sender is a hack to make a room specific handle
-                handle = self._conn.ensureContactHandle(name, sender=self._object_path)
-                handles.append(handle)
-
-        if handles:
-            self.MembersChanged('', handles, [], [], [],
-                    0, telepathy.CHANNEL_GROUP_CHANGE_REASON_NONE)
+        self.MembersChanged('', [int(self._conn.GetSelfHandle())], [], [], [],
+                0, telepathy.CHANNEL_GROUP_CHANGE_REASON_NONE)
@@ -19,6 +19,7 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
 import logging
+import time
 import weakref
 
 import dbus
@@ -29,6 +30,7 @@ from telepathy._generated.Channel_Interface_Messages import ChannelInterfaceMess
 from telepathy.interfaces import CHANNEL_INTERFACE_MESSAGES
 
 from glitter.channel import GlitterChannel
+from glitter.util import latency, tracing
 
 __all__ = ['GlitterTextChannel']
 
@@ -42,12 +44,12 @@ class GlitterTextChannel(
 ):
     def __init__(self, conn, manager, room, props, object_path=None):
         logger.debug("GlitterTextChannel: %s", room)
-        for k in props:
-            logger.debug("GlitterTextChannel: %s: %s", k, props[k])
         self._recv_id = 0
         self._conn_ref = weakref.ref(conn)
         self._room = room
-        self._room.messageSent.connect(self._signal_text_sent)
+        self._outbox = conn.outbox
+        self._outbox.delivered.connect(self._signal_text_sent)
+        self._outbox.failed.connect(self._signal_send_failed)
         self._room.messagesReceived.connect(self._signal_text_received)
         self._pending_counter = itertools.count()
         self._room.startMessageStream()
@@ -88,21 +90,65 @@ class GlitterTextChannel(
         else:
             return set()
 
-    def _signal_text_sent(self, message_id):
-        logger.debug("_signal-text-sent: %s", message_id)
-        message = self._room.messages[message_id]
-        message_type = telepathy.CHANNEL_TEXT_MESSAGE_TYPE_NORMAL
-        headers = {'message-sent': message.sent_timestamp,
-                   'message-type': message_type}
-        plain = {'content-type': 'text/plain',
-                 'content': message.text}
-        html = {'content-type': 'text/html',
-                'content': message.html}
-        self.Sent(message.sent_timestamp, message_type, message.text)
-        self.MessageSent([headers, plain, html], 0, '')
+    def _signal_text_sent(self, room, token, message_id):
+        if room != self._room.name:
+            return
+        logger.debug("_signal-text-sent: %s %s", token, message_id)
+        message = self._room.messages.get(message_id)
+        if message is not None:
+            message_type = telepathy.CHANNEL_TEXT_MESSAGE_TYPE_NORMAL
+            headers = {'message-sent': message.sent_timestamp,
+                       'message-type': message_type}
+            plain = {'content-type': 'text/plain',
+                     'content': message.text}
+            html = {'content-type': 'text/html',
+                    'content': message.html}
+            self.Sent(message.sent_timestamp, message_type, message.text)
+            self.MessageSent([headers, plain, html], 0, token)
+        self._signal_delivery_report(token, telepathy.DELIVERY_STATUS_DELIVERED)
+
+    def _signal_send_failed(self, room, token, permanent, error):
+        if room != self._room.name:
+            return
+        if permanent:
+            self._signal_delivery_report(
+                token, telepathy.DELIVERY_STATUS_PERMANENTLY_FAILED,
+                telepathy.CHANNEL_TEXT_SEND_ERROR_UNKNOWN, error)
+        else:
+            self._signal_delivery_report(
+                token, telepathy.DELIVERY_STATUS_TEMPORARILY_FAILED,
+                telepathy.CHANNEL_TEXT_SEND_ERROR_OFFLINE, error)
+
+    def _signal_delivery_report(self, token, status, error=None, message=''):
+        pending_id = next(self._pending_counter)
+        timestamp = int(time.time())
+        sender = int(self._handle)
+        message_type = telepathy.CHANNEL_TEXT_MESSAGE_TYPE_DELIVERY_REPORT
+        # pending like any received message, so clients can list and
+        # acknowledge it. Received is left alone, reports aren't text
+        self._pending_messages[pending_id] = (
+            pending_id, timestamp, sender, message_type, 0, message)
+        headers = dbus.Dictionary({
+            'message-received': dbus.UInt64(timestamp),
+            'pending-message-id': pending_id,
+            'message-sender': dbus.UInt32(sender),
+            'message-type': message_type,
+            'delivery-status': dbus.UInt32(status),
+            'delivery-token': token,
+        }, signature='sv')
+        parts = dbus.Array([headers], signature='a{sv}')
+        if error is not None:
+            headers['delivery-error'] = dbus.UInt32(error)
+            # the spec carries the human readable reason as content
+            parts.append(dbus.Dictionary({
+                'content-type': 'text/plain',
+                'content': message,
+            }, signature='sv'))
+        self.MessageReceived(parts)
 
     def _signal_text_received(self, message_id):
-        logger.debug("_signal_text_received: %s", str(message_id))
+        if tracing.enabled:
+            tracing.record('text.received', self._room.name, message_id)
         message_type = telepathy.CHANNEL_TEXT_MESSAGE_TYPE_NORMAL
         pending_id = next(self._pending_counter)
         message = self._room.messages[message_id]
@@ -131,6 +177,7 @@ class GlitterTextChannel(
                       message_type,
                       0, message.text)
         self.MessageReceived(message_parts)
+        latency.tracker().finish(message)
 
     @dbus.service.method(telepathy.CHANNEL_TYPE_TEXT,
                          in_signature='us',
@@ -142,6 +189,8 @@ class GlitterTextChannel(
     def Close(self):
         logger.debug("Close %s %s %s", self._room, type(self._room), self._room.messages.last_id)
         self._room.saveLastMessageId()
+        self._outbox.delivered.disconnect(self._signal_text_sent)
+        self._outbox.failed.disconnect(self._signal_send_failed)
         if self._room is not None:
             self._room.disconnect()
         telepathy.server.ChannelTypeText.Close(self)
@@ -167,8 +216,9 @@ class GlitterTextChannel(
         if text is None:
                 raise telepathy.NotImplemented("Unhandled message type")
 
-        self._room.sendMessage(text)
-        _success('')
+        # queued on disk first so nothing typed is lost to a dropped
+        # connection, delivery reports follow once gitter has it
+        _success(self._outbox.queue(self._room.name, text))
 
     # Redefine GetSelfHandle since we use our own handle
     #  as Glitter doesn't have channel specific handles
@@ -178,5 +228,4 @@ class GlitterTextChannel(
     @dbus.service.signal(telepathy.CHANNEL_INTERFACE_MESSAGES,
                          signature='aa{sv}')
     def MessageReceived(self, message):
-        logger.debug("MessageReceived: %s", message)
         pass
@@ -26,11 +26,8 @@ import itertools
 import telepathy
 
 # from glitter.channel.im import GlitterImChannel
-# from glitter.channel.muc import GlitterMucChannel
 # from glitter.channel.conference import GlitterConferenceChannel
 
-from glitter.channel.text import GlitterTextChannel
-
 __all__ = ['GlitterChannelManager']
 
 logger = logging.getLogger('Glitter.ChannelManager')
@@ -99,11 +96,13 @@ class GlitterChannelManager(telepathy.server.ChannelManager):
         handle = props.get(telepathy.CHANNEL_INTERFACE + '.TargetHandle')
         room = self._conn.roomFromHandle(handle)
 
-        # if room.oneToOne:
-        #     channel = GlitterImChannel(self._conn, self, room, props,
-        #                                object_path=path)
-        # else:
-        channel = GlitterTextChannel(self._conn, self, room, props,
-                                     object_path=path)
+        if room.oneToOne:
+            from glitter.channel.text import GlitterTextChannel
+            channel = GlitterTextChannel(self._conn, self, room, props,
+                                         object_path=path)
+        else:
+            from glitter.channel.muc import GlitterMucChannel
+            channel = GlitterMucChannel(self._conn, self, room, props,
+                                        object_path=path)
 
         return channel
@@ -0,0 +1,114 @@
+# telepathy-glitter - an Gitter connection manager for Telepathy
+#
+# Copyright (C) 2015 Diane Trout
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""JSON encoding and decoding with the fastest available library
+
+orjson is preferred, then ujson, falling back to the standard json
+module. Every backend decodes straight from the bytes we get off the
+wire, without decoding them to str first.
+"""
+import json
+import logging
+
+__all__ = ['BACKEND', 'loads', 'dumps', 'backends', 'get_backend']
+
+logger = logging.getLogger('Glitter.Codec')
+
+PREFERRED_BACKENDS = ['orjson', 'ujson', 'json']
+
+
+def _as_buffer(data):
+    """Return data as something every backend can decode
+
+    QByteArray and memoryview get turned into bytes, since the stdlib
+    json can't read a memoryview. Other buffers pass through.
+    """
+    if isinstance(data, (bytes, bytearray, str)):
+        return data
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data.data()
+
+
+def _orjson():
+    import orjson
+
+    def loads(data):
+        return orjson.loads(_as_buffer(data))
+
+    return loads, orjson.dumps
+
+
+def _ujson():
+    import ujson
+
+    def loads(data):
+        data = _as_buffer(data)
+        if isinstance(data, bytearray):
+            data = bytes(data)
+        return ujson.loads(data)
+
+    def dumps(obj):
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+    return loads, dumps
+
+
+def _json():
+    def loads(data):
+        # json detects the utf encoding of bytes itself
+        return json.loads(_as_buffer(data))
+
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False,
+                          separators=(',', ':')).encode('utf-8')
+
+    return loads, dumps
+
+
+_FACTORIES = {
+    'orjson': _orjson,
+    'ujson': _ujson,
+    'json': _json,
+}
+
+
+def get_backend(name):
+    """Return the (loads, dumps) pair of a backend
+
+    Raises ImportError if the library isn't installed.
+    """
+    return _FACTORIES[name]()
+
+
+def backends():
+    """Return the names of the installed backends, fastest first
+    """
+    available = []
+    for name in PREFERRED_BACKENDS:
+        try:
+            get_backend(name)
+        except ImportError:
+            continue
+        available.append(name)
+    return available
+
+
+BACKEND = backends()[0]
+loads, dumps = get_backend(BACKEND)
+logger.debug("Using %s for json", BACKEND)
@@ -23,16 +23,19 @@
 
 import weakref
 import logging
-from pprint import pformat
 
 import dbus
 import telepathy
 
+from glitter.avatars import GlitterAvatars
 from glitter.capabilities import GlitterCapabilities
 #from glitter.handle import GlitterHandleFactory, network_to_extension
 from glitter.contacts import GlitterContacts
 from glitter.channel_manager import GlitterChannelManager
+from glitter.outbox import Outbox
 from glitter.rooms import GitterClient
+from glitter.snapshot import Snapshot, HandleStore
+from glitter.util import tracing
 
 __all__ = ['GlitterConnection']
 
@@ -44,16 +47,22 @@ class GlitterConnection(
         telepathy.server.ConnectionInterfaceRequests,
         GlitterCapabilities,
         GlitterContacts,
+        GlitterAvatars,
 ):
     def __init__(self, protocol, manager, parameters):
         protocol.check_parameters(parameters)
 
         try:
             account = parameters['account']
+            # (handle type, name) -> handle
+            self._handle_index = weakref.WeakValueDictionary()
 
             self._manager = weakref.proxy(manager)
             self._account = {'account': parameters['account'],
                              'token': parameters['token']}
+            self._snapshot = Snapshot(account)
+            self._handle_store = HandleStore(account)
+            self._outbox = Outbox(account)
 
             # Call parent initializers
             telepathy.server.Connection.__init__(
@@ -61,6 +70,7 @@ class GlitterConnection(
             telepathy.server.ConnectionInterfaceRequests.__init__(self)
             GlitterCapabilities.__init__(self)
             GlitterContacts.__init__(self)
+            GlitterAvatars.__init__(self)
             self._channel_manager = GlitterChannelManager(self, protocol)
 
             self_handle = self.create_handle(
@@ -97,6 +107,32 @@ class GlitterConnection(
     def gitter_client(self):
         return self._gitter_client
 
+    @property
+    def outbox(self):
+        return self._outbox
+
+    def get_handle_id(self):
+        return self._handle_store.next_id()
+
+    def create_handle(self, handle_type, handle_name, persist=True, **kwargs):
+        """Create a handle, reusing the id the name had in earlier sessions
+
+        Without persist the id is only good for this session.
+        """
+        handle_id = self._handle_store.assign(handle_type, handle_name, persist)
+        handle = telepathy.server.Handle(handle_id, handle_type, handle_name)
+        self._handles[handle_type, handle_id] = handle
+        self._handle_index[handle_type, handle_name] = handle
+        return handle
+
+    def ensure_handle(self, handle_type, handle_name, persist=True):
+        """Find a handle by name without scanning every handle we own
+        """
+        handle = self._handle_index.get((handle_type, handle_name))
+        if handle is None:
+            handle = self.create_handle(handle_type, handle_name, persist)
+        return handle
+
     def roomFromHandle(self, handle):
         """Retrieve a gitter client room given a telepathy handle
         """
@@ -114,10 +150,13 @@ class GlitterConnection(
             self.StatusChanged(telepathy.CONNECTION_STATUS_CONNECTING,
                                telepathy.CONNECTION_STATUS_REASON_NONE_SPECIFIED)
             self.__disconnect_reason = telepathy.CONNECTION_STATUS_REASON_NONE_SPECIFIED
-            self._gitter_client = GitterClient(self, self._account['token'])
+            self._gitter_client = GitterClient(
+                self, self._account['token'], self._account['account'])
             self._gitter_client.connected.connect(
                 lambda sender=sender: self.connected(sender))
-            self._gitter_client.connect()
+            # go online with the rooms we knew about last time, the
+            # live listing is reconciled with them once it arrives
+            self._gitter_client.connect(self._snapshot.load())
 
     def connected(self, sender):
         logger.info("Connected %s", sender)
@@ -126,15 +165,31 @@ class GlitterConnection(
         self.update_handles(sender)
         self.check_connected()
         self._populate_capabilities()
+        rooms = self._gitter_client.rooms
+        rooms.changed.connect(
+            lambda added, removed, updated, sender=sender:
+                self.rooms_changed(added, removed, updated, sender))
+        if rooms.live:
+            self._snapshot.save(rooms.snapshot())
+        self._outbox.attach(rooms)
+
+    def rooms_changed(self, added, removed, updated, sender):
+        logger.info("Rooms changed: %d added, %d removed, %d updated",
+                    len(added), len(removed), len(updated))
+        self.reconcile_handles(added, removed, updated, sender)
+        self._snapshot.save(self._gitter_client.rooms.snapshot())
+        self._outbox.flush()
 
     def Disconnect(self):
         logger.info("Disconnecting")
         self.__disconnect_reason = telepathy.CONNECTION_STATUS_REASON_REQUESTED
+        self._outbox.detach()
         self._gitter_client.disconnect()
         self._disconnected()
 
     def _disconnected(self):
         logger.info("Disconnected")
+        self._handle_store.save()
         self.StatusChanged(
             telepathy.CONNECTION_STATUS_DISCONNECTED,
             self.__disconnect_reason)
@@ -193,8 +248,8 @@ class GlitterConnection(
         sender_keyword='sender')
     def CreateChannel(self, request, _success, _error, sender):
         self.check_connected()
-        for k, v in request:
-            print('Create', k, v)
+        if tracing.enabled:
+            tracing.record('channel.create', sender, sorted(request))
         channel = request.get(telepathy.CHANNEL_INTERFACE + '.ChannelType')
         handle = self.handleFromRequest(request, sender)
         raise NotImplemented()
@@ -206,8 +261,6 @@ class GlitterConnection(
         async_callbacks=('_success', '_error'),
         sender_keyword='sender')
     def EnsureChannel(self, request, _success, _error, sender):
-        for key in request:
-            logger.debug("EnsureChannel: %s %s", str(key), str(request[key]))
         self.check_connected()
 
         channel_manager = self._channel_manager
@@ -215,7 +268,9 @@ class GlitterConnection(
 
         handle = self.handleFromRequest(request, sender)
         props = self._generate_props(channel_type, handle, True)
-        logger.debug("EnsureChannel props: %s", pformat(props))
+        if tracing.enabled:
+            tracing.record('channel.ensure', sender, channel_type,
+                           handle.get_name())
         self._validate_handle(props)
 
         yours, channel = channel_manager.channel_for_props(
@@ -19,16 +19,33 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 
+import dbus
+import json
+import os
+import signal
 import telepathy
-from PyQt5.QtCore import QTimer
 import logging
 
 from glitter.protocol import GlitterProtocol
+from glitter.ingest import ingest
+from glitter.util import latency, mainloop, metrics, profiling, tracing
+from glitter.util.monitor import LoopMonitor
 
-__all__ = ['GlitterConnectionManager']
+__all__ = ['GlitterConnectionManager', 'DEBUG_INTERFACE']
 
 logger = logging.getLogger('Glitter.ConnectionManager')
 
+# glitter specific introspection, not part of the telepathy spec
+DEBUG_INTERFACE = 'org.glitter.Debug'
+
+# set to write Prometheus metrics for node_exporter's textfile collector
+METRICS_TEXTFILE = 'GLITTER_METRICS_TEXTFILE'
+METRICS_INTERVAL = 'GLITTER_METRICS_INTERVAL'
+# seconds between textfile writes when the environment doesn't say
+DEFAULT_METRICS_INTERVAL = 60
+# set to also count the bytes of every D-Bus signal, which costs a bit
+METRICS_SIGNAL_BYTES = 'GLITTER_METRICS_SIGNAL_BYTES'
+
 
 class GlitterConnectionManager(telepathy.server.ConnectionManager):
     """Gitter connection manager
@@ -42,20 +59,149 @@ class GlitterConnectionManager(telepathy.server.ConnectionManager):
         self._implement_protocol('gitter', GlitterProtocol)
 
         self._shutdown = shutdown_func
+        self._mainloop = mainloop.scheduler()
+        self._monitor = LoopMonitor()
+        self._monitor.start()
+        self._setupMetrics()
+        tracing.installSignalHandler(signal.SIGUSR1)
+        profiling.installSignalHandler(signal.SIGUSR2)
         logger.info("Connection manager created")
 
+    def _setupMetrics(self):
+        registry = metrics.registry()
+        self._scheduler_depth = registry.gauge(
+            'glitter_mainloop_queue_depth', 'Main loop work waiting', ['queue'])
+        self._loop_lag = registry.gauge(
+            'glitter_mainloop_max_lag_seconds', 'Worst main loop lag seen')
+        self._ingest_pending = registry.gauge(
+            'glitter_ingest_pending', 'Payloads waiting on the ingest thread')
+        registry.addCollector(self._collectMetrics)
+        metrics.instrumentBus(dbus.SessionBus(), payloadBytes=bool(
+            os.environ.get(METRICS_SIGNAL_BYTES)))
+
+        self._exporter = None
+        filename = os.environ.get(METRICS_TEXTFILE)
+        if filename:
+            self._exporter = metrics.TextfileExporter(
+                filename, self._metricsInterval() * 1000)
+            self._exporter.start()
+
+    def _metricsInterval(self):
+        value = os.environ.get(METRICS_INTERVAL)
+        if value is None:
+            return DEFAULT_METRICS_INTERVAL
+        try:
+            interval = int(value)
+        except ValueError:
+            interval = 0
+        if interval <= 0:
+            logger.warning("Ignoring %s=%r, writing metrics every %ds",
+                           METRICS_INTERVAL, value, DEFAULT_METRICS_INTERVAL)
+            return DEFAULT_METRICS_INTERVAL
+        return interval
+
+    def _collectMetrics(self):
+        status = self._mainloop.status()
+        for queue in ('idle', 'timer', 'throttled'):
+            self._scheduler_depth.set(status[queue + '_depth'], queue=queue)
+        self._loop_lag.set(self._monitor.report()['max_lag_ms'] / 1000)
+        self._ingest_pending.set(ingest().status()['pending'])
+
     def disconnected(self, conn):
         def shutdown():
             if self._shutdown is not None and \
                     len(self._connections) == 0:
                 self._shutdown()
-            return False
         telepathy.server.ConnectionManager.disconnected(self, conn)
-        QTimer().singleShot(5000, shutdown)
+        self._mainloop.callLater(5000, shutdown)
 
     def quit(self):
         "Terminates all connections. Must be called upon quit"
         conns = self._connections.copy()
         for connection in conns:
             connection.Disconnect()
+        self._monitor.stop()
+        profiling.profiler().stop()
+        if self._exporter is not None:
+            self._exporter.write()
+            self._exporter.stop()
         logger.info("Connection manager quitting")
+
+    @dbus.service.method(DEBUG_INTERFACE, in_signature='', out_signature='s')
+    def GetLoopReport(self):
+        """Return main loop lag, stalls, scheduler queues and the request
+        schedulers of connected accounts as json
+        """
+        report = self._monitor.report()
+        report['scheduler'] = self._mainloop.status()
+        report['requests'] = {}
+        for connection in self._connections:
+            client = getattr(connection, 'gitter_client', None)
+            if client is not None:
+                report['requests'][connection._account['account']] = \
+                    client.scheduler.status()
+        return json.dumps(report)
+
+    @dbus.service.method(DEBUG_INTERFACE, in_signature='', out_signature='s')
+    def GetMetrics(self):
+        """Return every metric as json
+        """
+        return json.dumps(metrics.registry().snapshot())
+
+    @dbus.service.method(DEBUG_INTERFACE, in_signature='', out_signature='s')
+    def GetMetricsText(self):
+        """Return every metric in the Prometheus text format
+        """
+        return metrics.registry().exposition()
+
+    @dbus.service.method(DEBUG_INTERFACE, in_signature='', out_signature='s')
+    def GetMessageLatency(self):
+        """Return percentiles of the time streamed messages spend per step as json
+        """
+        return json.dumps(latency.tracker().report())
+
+    @dbus.service.method(DEBUG_INTERFACE, in_signature='u', out_signature='')
+    def EnableTracing(self, size):
+        """Record hot path events, keeping the last size of them (0 for the default)
+        """
+        tracing.enable(int(size) or None)
+
+    @dbus.service.method(DEBUG_INTERFACE, in_signature='', out_signature='')
+    def DisableTracing(self):
+        tracing.disable()
+
+    @dbus.service.method(DEBUG_INTERFACE, in_signature='', out_signature='s')
+    def DumpTrace(self):
+        """Return the recorded trace events as json
+        """
+        return tracing.dump()
+
+    @dbus.service.method(DEBUG_INTERFACE, in_signature='su', out_signature='s')
+    def StartProfiler(self, mode, seconds):
+        """Profile the main loop for seconds with cprofile or sample
+
+        Returns the file the results will be written to.
+        """
+        try:
+            return profiling.profiler().start(
+                str(mode), int(seconds) or profiling.DEFAULT_DURATION)
+        except ValueError as e:
+            raise telepathy.InvalidArgument(str(e))
+        except RuntimeError as e:
+            raise telepathy.NotAvailable(str(e))
+
+    @dbus.service.method(DEBUG_INTERFACE, in_signature='', out_signature='s')
+    def StopProfiler(self):
+        """Write the running profile now, returning its filename
+        """
+        return profiling.profiler().stop()
+
+    @dbus.service.method(DEBUG_INTERFACE, in_signature='u', out_signature='s')
+    def TakeMemorySnapshot(self, limit):
+        """Return allocation growth and glitter object counts as json
+        """
+        return json.dumps(profiling.profiler().memorySnapshot(int(limit) or 25))
+
+    @dbus.service.method(DEBUG_INTERFACE, in_signature='', out_signature='')
+    def StopMemoryTracing(self):
+        profiling.profiler().stopMemoryTracing()
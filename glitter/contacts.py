@@ -18,12 +18,13 @@
 
 
 import logging
-from pprint import pformat
 
 import telepathy
 import telepathy.errors
 import dbus
 
+from glitter.util import tracing
+
 
 __all__ = ['GlitterContacts']
 
@@ -45,7 +46,7 @@ class GlitterContacts(
         telepathy.CONNECTION_INTERFACE_CONTACT_BLOCKING: 'blocked',
         telepathy.CONNECTION_INTERFACE_SIMPLE_PRESENCE: 'presence',
         # telepathy.CONNECTION_INTERFACE_ALIASING: 'alias',
-        # telepathy.CONNECTION_INTERFACE_AVATARS: 'token',
+        telepathy.CONNECTION_INTERFACE_AVATARS: 'token',
         telepathy.CONNECTION_INTERFACE_CAPABILITIES: 'caps',
         telepathy.CONNECTION_INTERFACE_CONTACT_CAPABILITIES: 'capabilities'
         }
@@ -91,6 +92,11 @@ class GlitterContacts(
              'MaximumStatusMessageLength': lambda: 0}
         )
         self._contact_list_state = telepathy.CONTACT_LIST_STATE_NONE
+        # handle -> room name and the reverse
+        self._contact_handles = {}
+        self._contact_ids = {}
+        # user name -> handle for members of group rooms
+        self._member_ids = {}
 
     def get_contact_attribute_interfaces(self):
         return list(self.attributes.keys())
@@ -106,14 +112,46 @@ class GlitterContacts(
         self.ContactsChangedWithID(changes, self._contact_handles, removals)
         self.ContactsChanged(changes, removals)
 
+    def reconcile_handles(self, added, removed, updated, sender):
+        """Apply the difference between two room listings to the contact list
+
+        Parameters:
+          added: names of rooms new to the listing
+          removed: names of rooms gone from the listing
+          updated: names of rooms whose attributes changed
+          sender: dbus sender ID
+        """
+        self.newContactHandles(added, sender)
+        state = (telepathy.SUBSCRIPTION_STATE_YES,
+                 telepathy.SUBSCRIPTION_STATE_YES,
+                 '')
+        changes = {self._contact_ids[name]: state for name in added}
+        identifiers = {h: self._contact_handles[h] for h in changes}
+        removals = {}
+        for name in removed:
+            handle = self._contact_ids.pop(name, None)
+            if handle is not None:
+                removals[handle] = self._contact_handles.pop(handle)
+        if changes or removals:
+            self.ContactsChangedWithID(changes, identifiers, removals)
+            self.ContactsChanged(changes, list(removals))
+        if changes:
+            self._add_default_capabilities(list(changes))
+            self._update_contact_capabilities(list(changes))
+        if updated:
+            # picks up new avatars, AvatarUpdated follows the fetch
+            self.GetKnownAvatarTokens(
+                [self._contact_ids[name] for name in updated
+                 if name in self._contact_ids])
+
     def ensureContactHandle(self, contact, sender):
         """Find contact handle, allocate new one if not available
         """
-        for handle in self._contact_handles:
-            if contact == self._contact_handles[handle]:
-                return handle
-
-        self.newContactHandle(self, [contact], sender)
+        handle = self._contact_ids.get(contact)
+        if handle is None:
+            self.newContactHandles([contact], sender)
+            handle = self._contact_ids[contact]
+        return handle
 
     def newContactHandles(self, contacts, sender):
         """Create Contact Handles
@@ -122,10 +160,8 @@ class GlitterContacts(
           contacts: a list of glitter rooms
           sender: dbus sender ID
         """
-        logger.debug("newContactHandles: %s", contacts)
-        if not hasattr(self, '_contact_handles'):
-            self._contact_handles = {}
-
+        contacts = list(contacts)
+        logger.debug("newContactHandles: %d contacts", len(contacts))
         handles = self.RequestHandles(
             telepathy.HANDLE_TYPE_CONTACT,
             contacts,
@@ -133,6 +169,40 @@ class GlitterContacts(
 
         for handle, name in zip(handles, contacts):
             self._contact_handles[handle] = name
+            self._contact_ids[name] = handle
+
+    def ensureMemberHandles(self, usernames, sender):
+        """Return handles for room members, allocating any missing ones
+
+        Members are not part of the contact list, so they are tracked
+        separately from the room handles and their ids are not saved.
+
+        Parameters:
+          usernames: a list of gitter user names
+          sender: dbus sender ID
+        """
+        missing = [name for name in usernames if name not in self._member_ids]
+        if missing:
+            for name in missing:
+                self.ensure_handle(telepathy.HANDLE_TYPE_CONTACT, name,
+                                   persist=False)
+            handles = self.RequestHandles(
+                telepathy.HANDLE_TYPE_CONTACT,
+                missing,
+                sender=sender)
+            for handle, name in zip(handles, missing):
+                self._member_ids[name] = handle
+        return [self._member_ids[name] for name in usernames]
+
+    def forgetMemberHandles(self, handles):
+        """Stop tracking the member names of a closed room's roster
+
+        Members of rooms still open are looked up again when needed.
+        """
+        handles = set(int(handle) for handle in handles)
+        for name in [name for name, handle in self._member_ids.items()
+                     if int(handle) in handles]:
+            del self._member_ids[name]
 
     ### Start Contacts
     # Overwrite the dbus attribute to get the sender argument
@@ -141,9 +211,8 @@ class GlitterContacts(
                          out_signature='a{ua{sv}}',
                          sender_keyword='sender')
     def GetContactAttributes(self, handles, interfaces, hold, sender):
-        logger.debug("GetContactAttributes: %s, %s",
-                     ', '.join((str(x) for x in handles)),
-                     ', '.join(interfaces))
+        if tracing.enabled:
+            tracing.record('contacts.attributes', len(handles), list(interfaces))
         # InspectHandle already checks we're connected, the handles and handle type.
         supported_interfaces = set()
         for interface in interfaces:
@@ -304,7 +373,8 @@ class GlitterContacts(
         in_signature="au",
         out_signature="a{u(uss)}")
     def GetPresences(self, handles):
-        logger.debug("GetPresences: %s", handles)
+        if tracing.enabled:
+            tracing.record('contacts.presences', len(handles))
         ret = dbus.Dictionary(signature="u(uss)")
         for handle in handles:
             # return our status
@@ -321,7 +391,6 @@ class GlitterContacts(
             ret[handle] = dbus.Struct((status_id, status, message),
                                        signature="(uss)")
 
-        logger.debug("GetPresences ret: %s", pformat(ret))
         return ret
 
     def GetStatuses(self):
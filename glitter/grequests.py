@@ -1,39 +1,761 @@
-from PyQt5.QtNetwork import QNetworkRequest
-import json
+from PyQt5.QtCore import QByteArray, QObject, pyqtSignal
+from PyQt5.QtNetwork import QNetworkReply, QNetworkRequest
+from email.utils import parsedate_to_datetime
+import collections
 import logging
+import re
+import time
+import zlib
+
+from glitter import codec
+from glitter.ingest import ingest
+from glitter.util import mainloop, metrics
 
 logger = logging.getLogger(__name__)
 
+# marks a ScheduledRequest whose body has not been decoded yet
+_UNDECODED = object()
 
-def makeRequest(url, token):
-    logger.debug("makeRequest: %s", url)
-    req = QNetworkRequest(url)
-    req.setRawHeader(b"Accept", b"application/json")
-    req.setRawHeader(b"Authorization", b'Bearer ' + bytes(token))
-    return req
+_REQUEST_SECONDS = metrics.registry().histogram(
+    'glitter_request_duration_seconds',
+    'Time from sending a gitter api request to its last byte',
+    ['method', 'endpoint'])
+_REQUESTS = metrics.registry().counter(
+    'glitter_requests_total', 'Finished gitter api requests',
+    ['method', 'endpoint', 'status'])
+_QUEUE_DEPTH = metrics.registry().gauge(
+    'glitter_request_queue_depth', 'Requests waiting to start',
+    ['account', 'priority'])
+_ACTIVE_REQUESTS = metrics.registry().gauge(
+    'glitter_requests_active', 'Requests running', ['account', 'priority'])
+_TRANSFER_BYTES = metrics.registry().gauge(
+    'glitter_response_bytes',
+    'Response bytes received off the wire and after decompression',
+    ['account', 'stage'])
+_THROTTLED = metrics.registry().counter(
+    'glitter_rate_limit_throttled_total',
+    'Times the rate limit governor held requests back', ['reason'])
 
+# room and message ids in api paths
+_OBJECT_ID = re.compile(r'/[0-9a-f]{24}(?=/|$)')
 
-def readResponse(resp):
-    error = resp.error()
-    data = resp.readAll()
-    if error == 0:
+
+def endpointName(url):
+    """Return the path of an api url with object ids replaced by :id
+    """
+    return _OBJECT_ID.sub('/:id', url.path())
+
+
+class RequestTemplate(object):
+    """Headers and attributes shared by every request of an account
+
+    They are set once on a prototype request, new requests are copies
+    of it, QNetworkRequest being implicitly shared, with only the url
+    changed.
+    """
+    # request attributes set centrally, skipping those this Qt lacks
+    ATTRIBUTES = [
+        ('HttpPipeliningAllowedAttribute', True),
+        ('SpdyAllowedAttribute', True),
+        ('HTTP2AllowedAttribute', True),
+    ]
+
+    def __init__(self, token):
+        self._prototype = QNetworkRequest()
+        self._prototype.setRawHeader(b"Accept", b"application/json")
+        # setting this ourselves stops Qt from inflating bodies behind
+        # our back, so ScheduledRequest can count the bytes either side
+        self._prototype.setRawHeader(b"Accept-Encoding", b"gzip, deflate")
+        self._prototype.setRawHeader(b"Authorization",
+                                     b'Bearer ' + bytes(token))
+        for name, value in self.ATTRIBUTES:
+            attribute = getattr(QNetworkRequest, name, None)
+            if attribute is not None:
+                self._prototype.setAttribute(attribute, value)
+
+        self._json_prototype = QNetworkRequest(self._prototype)
+        self._json_prototype.setRawHeader(b'Content-Type',
+                                          b'application/json')
+
+    def request(self, url):
+        req = QNetworkRequest(self._prototype)
+        req.setUrl(url)
+        return req
+
+    def jsonRequest(self, url):
+        """Request for posting a json body
+        """
+        req = QNetworkRequest(self._json_prototype)
+        req.setUrl(url)
+        return req
+
+
+def _decodeResponse(resp, data):
+    if resp.error() == 0:
         # logger.debug("readResponse: %s", data)
         if len(data) > 0:
-            body = bytes(data)
             # FIXME: figure out actual content type
-            jsonobj = json.loads(body.decode('utf-8'))
-            return jsonobj
+            return codec.loads(data)
     else:
-        logger.error('Error: %s', data)
+        logger.error('Error %s: %s',
+                     resp.attribute(QNetworkRequest.HttpStatusCodeAttribute),
+                     data)
+
+
+def readResponse(resp):
+    if isinstance(resp, ScheduledRequest):
+        return resp.result()
+    return _decodeResponse(resp, resp.readAll())
+
+
+def readLines(resp):
+    """Return the complete lines buffered on a streaming reply
+    """
+    lines = []
+    while resp.canReadLine():
+        line = bytes(resp.readLine())
+        if resp.error() != 0:
+            logger.error('Error: %s', line)
+            break
+        lines.append(line)
+    return lines
+
+
+# Priority classes, most urgent first
+PRIORITY_SEND = 0
+PRIORITY_HISTORY = 1
+PRIORITY_BACKFILL = 2
+PRIORITY_REFRESH = 3
+# long lived event streams, never held back
+PRIORITY_STREAM = 4
+
+# QNetworkAccessManager opens at most six connections per host and
+# queues anything beyond that itself, in arrival order. Keeping the
+# api classes to six in total means Qt never parks a send behind
+# history pages.
+CLASS_LIMITS = {
+    PRIORITY_SEND: 2,
+    PRIORITY_HISTORY: 2,
+    PRIORITY_BACKFILL: 1,
+    PRIORITY_REFRESH: 1,
+    PRIORITY_STREAM: None,
+}
+
+
+# classes held back when the rate limit budget runs low
+DEFERRABLE_PRIORITIES = frozenset([PRIORITY_BACKFILL, PRIORITY_REFRESH])
+
+# finished results kept for reuse at most, oldest dropped first
+RESULT_CACHE_SIZE = 64
+
+
+def _headerInt(reply, name):
+    value = bytes(reply.rawHeader(name)).strip()
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+class RateLimitGovernor(QObject):
+    """Track the account's api budget from response headers
+
+    One governor is shared by every room of a connection. Once the
+    remaining budget falls under twice the reserve, deferrable requests
+    are spread over what is left of the window, and under the reserve
+    they wait for the reset so sends and channel opens still get
+    through. A 429 holds back everything until its Retry-After passes.
+    """
+    def __init__(self, reserve=0.1):
+        super().__init__()
+        self._reserve = reserve
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None
+        self.blocked_until = 0
+        self.throttle_events = 0
+        self._last_deferred_start = 0
+        # classes already counted as held back for budget
+        self._budget_waits = set()
+
+    # reason, delay in milliseconds
+    throttled = pyqtSignal(str, int)
+
+    def update(self, reply):
+        """Record the budget advertised by a finished reply
+        """
+        limit = _headerInt(reply, b'X-RateLimit-Limit')
+        remaining = _headerInt(reply, b'X-RateLimit-Remaining')
+        reset = _headerInt(reply, b'X-RateLimit-Reset')
+        if limit is not None:
+            self.limit = limit
+        if remaining is not None:
+            self.remaining = remaining
+        if reset is not None:
+            # gitter sends milliseconds, be lenient about seconds
+            self.reset_at = reset / 1000 if reset > 10 ** 11 else reset
+
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if status == 429:
+            retry = self._retryAfter(reply)
+            self.blocked_until = max(self.blocked_until, time.time() + retry)
+            self._throttled('retry-after', retry)
+
+    def _retryAfter(self, reply):
+        value = bytes(reply.rawHeader(b'Retry-After')).decode('latin-1').strip()
+        if value.isdigit():
+            return int(value)
+        try:
+            return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+        if self.reset_at:
+            return max(1, self.reset_at - time.time())
+        return 60
+
+    def _throttled(self, reason, seconds):
+        self.throttle_events += 1
+        logger.info("rate limit: %s, waiting %.1fs", reason, seconds)
+        self.throttled.emit(reason, int(seconds * 1000))
+
+    def delay(self, priority):
+        """Return how many seconds a request of this class must wait
+        """
+        now = time.time()
+        if self.blocked_until > now:
+            return self.blocked_until - now
+        delay = self._budgetDelay(priority, now)
+        if delay <= 0:
+            self._budget_waits.discard(priority)
+        elif priority not in self._budget_waits:
+            # the scheduler asks again on every dispatch, count the
+            # wait once
+            self._budget_waits.add(priority)
+            self._throttled('budget', delay)
+        return delay
+
+    def _budgetDelay(self, priority, now):
+        if (priority not in DEFERRABLE_PRIORITIES or
+                self.remaining is None or not self.limit or
+                self.reset_at is None or self.reset_at <= now):
+            return 0
+
+        until_reset = self.reset_at - now
+        reserve = self.limit * self._reserve
+        spare = self.remaining - reserve
+        if spare <= 0:
+            return until_reset
+        if spare < reserve:
+            spacing = until_reset / spare
+            return max(0, self._last_deferred_start + spacing - now)
+        return 0
+
+    def started(self, priority):
+        if priority in DEFERRABLE_PRIORITIES:
+            self._last_deferred_start = time.time()
+        self._budget_waits.discard(priority)
+
+    def status(self):
+        return {
+            'limit': self.limit,
+            'remaining': self.remaining,
+            'reset': self.reset_at,
+            'blocked_until': self.blocked_until,
+            'throttle_events': self.throttle_events,
+        }
+
+
+class TransferStats(object):
+    """Bytes received off the wire and after decompression
+    """
+    def __init__(self):
+        self.wire_bytes = 0
+        self.decoded_bytes = 0
+
+    def status(self):
+        return {'wire_bytes': self.wire_bytes,
+                'decoded_bytes': self.decoded_bytes}
+
+
+class _Inflater(object):
+    """Streaming decompressor for a gzip or deflate body
+
+    Servers disagree on whether deflate means zlib wrapped or raw, so
+    a deflate body that doesn't start with a zlib header is retried
+    as raw deflate.
+    """
+    def __init__(self, encoding):
+        self._raw_fallback = encoding == b'deflate'
+        self._started = False
+        # accepts both gzip and zlib headers
+        self._decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    @classmethod
+    def forEncoding(cls, encoding):
+        if encoding in (b'gzip', b'x-gzip', b'deflate'):
+            return cls(encoding)
+
+    def decompress(self, data):
+        try:
+            out = self._decompressor.decompress(data)
+        except zlib.error:
+            if not self._raw_fallback or self._started:
+                raise
+            self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+            out = self._decompressor.decompress(data)
+        self._started = True
+        return out
+
+    def flush(self):
+        return self._decompressor.flush()
+
+
+class ScheduledRequest(QObject):
+    """A request waiting in, or started by, the RequestScheduler
+
+    It stands in for the QNetworkReply so readResponse and friends
+    work the same on either. Cancelled requests never emit finished.
+
+    Apart from streams, the body is kept once the request finishes
+    and decoded at most once, since one request may be shared by
+    several callers.
+    """
+    def __init__(self, scheduler, operation, request, data, priority, owner):
+        super().__init__()
+        self._scheduler = scheduler
+        self._operation = operation
+        self._request = request
+        self._data = data
+        self._reply = None
+        self._cancelled = False
+        self._finished = False
+        self._error = QNetworkReply.NoError
+        self._errorString = ''
+        self._status = None
+        self._body = None
+        self._result = _UNDECODED
+        self._resultCallbacks = None
+        # decoded bytes not read yet
+        self._buffer = bytearray()
+        self._inflater = None
+        # why the body couldn't be inflated, the request then fails
+        self._inflateError = None
+        self.priority = priority
+        # monotonic time the request last went out
+        self.startedAt = None
+        # owners waiting on this request, None for callers that
+        # never cancel
+        self.owners = [owner]
+
+    readyRead = pyqtSignal()
+    finished = pyqtSignal()
+
+    @classmethod
+    def fromFinished(cls, scheduler, other):
+        """Copy of a finished request, for result cache hits
+        """
+        copy = cls(scheduler, other._operation, other._request, None,
+                   other.priority, None)
+        copy._finish(other._error, other._errorString, other._status,
+                     other._body)
+        copy._result = other._result
+        return copy
+
+    def _start(self, net):
+        self._reply = None
+        self._buffer = bytearray()
+        self._inflater = None
+        self._inflateError = None
+        if self._operation == 'POST':
+            self._reply = net.post(self._request, self._data)
+        else:
+            self._reply = net.get(self._request)
+        self._reply.metaDataChanged.connect(self._readMetaData)
+        self._reply.readyRead.connect(self._read)
+        return self._reply
 
+    def _readMetaData(self):
+        encoding = bytes(self._reply.rawHeader(b'Content-Encoding'))
+        self._inflater = _Inflater.forEncoding(encoding.strip().lower())
 
-def readLongResponse(resp):
-    error = resp.error()
-    line = bytes(resp.readLine())
-    if error == 0:
-        line = line.decode('utf-8').strip()
-        if len(line) > 0:
-            jsonobj = json.loads(line)
-            return jsonobj
+    def _read(self):
+        if self._receive(bytes(self._reply.readAll())):
+            self.readyRead.emit()
+
+    def _receive(self, data, final=False):
+        """Add bytes off the wire to the buffer, inflating if needed
+        """
+        stats = self._scheduler.stats
+        stats.wire_bytes += len(data)
+        if self._inflateError is not None:
+            return False
+        if self._inflater is not None:
+            try:
+                data = self._inflater.decompress(data)
+                if final:
+                    data += self._inflater.flush()
+            except zlib.error as e:
+                logger.error("Unable to inflate %s: %s",
+                             self._request.url().toString(), e)
+                # rather no body than one that is half still compressed
+                self._inflateError = "Unable to inflate body: {}".format(e)
+                del self._buffer[:]
+                if not final:
+                    self._reply.abort()
+                return False
+        stats.decoded_bytes += len(data)
+        self._buffer += data
+        return len(data) > 0
+
+    def _drain(self):
+        """Read whatever the reply still holds once it has finished
+        """
+        self._receive(bytes(self._reply.readAll()), final=True)
+
+    def _finish(self, error, errorString, status, body=None):
+        self._finished = True
+        self._error = error
+        self._errorString = errorString
+        self._status = status
+        self._body = body
+
+    @property
+    def reply(self):
+        return self._reply
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    @property
+    def key(self):
+        """Requests with the same key fetch the same resource
+        """
+        return (self._request.url().toString(),
+                bytes(self._request.rawHeader(b'Authorization')))
+
+    @property
+    def shareable(self):
+        return self._operation == 'GET' and self.priority != PRIORITY_STREAM
+
+    def isFinished(self):
+        return self._finished
+
+    def abort(self):
+        self._scheduler.cancelRequest(self)
+
+    def result(self):
+        """Return the decoded json body, decoding it on first use
+        """
+        if self._result is _UNDECODED:
+            self._result = _decodeResponse(self, self.readAll())
+        return self._result
+
+    def resultLater(self, callback):
+        """Call callback with the decoded body, decoding large bodies
+        incrementally. Waiters sharing this request share one decode.
+        """
+        if self._result is not _UNDECODED:
+            callback(self._result)
+        elif self._resultCallbacks is not None:
+            self._resultCallbacks.append(callback)
+        else:
+            self._resultCallbacks = [callback]
+            readResponseLater(_FinishedBody(self), self._setResult)
+
+    def _setResult(self, result):
+        self._result = result
+        callbacks, self._resultCallbacks = self._resultCallbacks, None
+        for callback in callbacks:
+            callback(result)
+
+    def error(self):
+        if self._cancelled:
+            return QNetworkReply.OperationCanceledError
+        if self._finished or self._reply is None:
+            return self._error
+        return self._reply.error()
+
+    def errorString(self):
+        if self._finished or self._reply is None:
+            return self._errorString
+        return self._reply.errorString()
+
+    def attribute(self, code):
+        if self._finished:
+            if code == QNetworkRequest.HttpStatusCodeAttribute:
+                return self._status
+        elif self._reply is not None:
+            return self._reply.attribute(code)
+
+    def rawHeader(self, name):
+        if self._finished or self._reply is None:
+            return QByteArray()
+        return self._reply.rawHeader(name)
+
+    def readAll(self):
+        if self._body is not None:
+            return self._body
+        data = bytes(self._buffer)
+        del self._buffer[:]
+        return data
+
+    def readLine(self):
+        end = self._buffer.find(b'\n') + 1 or len(self._buffer)
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end]
+        return line
+
+    def canReadLine(self):
+        return b'\n' in self._buffer
+
+
+class _FinishedBody(object):
+    """Reply-like view of a ScheduledRequest's kept body
+    """
+    def __init__(self, pending):
+        self._pending = pending
+
+    def readAll(self):
+        return self._pending.readAll()
+
+    def error(self):
+        return self._pending.error()
+
+    def attribute(self, code):
+        return self._pending.attribute(code)
+
+
+class RequestScheduler(QObject):
+    """Order every gitter api request by priority class
+
+    Each class runs at most CLASS_LIMITS requests at once and the most
+    urgent class with a free slot is started first. Requests can be
+    tagged with an owner so everything a room or channel asked for can
+    be dropped with cancel() when it closes. The RateLimitGovernor
+    decides when each class may go and 429 replies are retried once
+    it allows.
+
+    Identical GETs made while one is already queued or running share
+    it, and with a result_ttl finished results are reused for that many
+    seconds.
+    """
+    def __init__(self, net, limits=CLASS_LIMITS, result_ttl=0, account=''):
+        super().__init__()
+        self._net = net
+        # labels this scheduler's metrics apart from other accounts'
+        self._account = account
+        self._governor = RateLimitGovernor()
+        self._wakeup = None
+        self._limits = dict(limits)
+        self._priorities = sorted(self._limits)
+        self._queues = {p: collections.deque() for p in self._priorities}
+        self._active = {p: set() for p in self._priorities}
+        # request key -> shareable request queued or running
+        self._inflight = {}
+        self._result_ttl = result_ttl
+        # request key -> (expiry time, finished request), soonest to
+        # expire first since every entry gets the same ttl
+        self._results = collections.OrderedDict()
+        self.stats = TransferStats()
+        self.coalesced = 0
+        self._governor.throttled.connect(self._throttled)
+        metrics.registry().addCollector(self._collectMetrics)
+
+    def get(self, request, priority=PRIORITY_REFRESH, owner=None):
+        return self._submit(ScheduledRequest(
+            self, 'GET', request, None, priority, owner))
+
+    def post(self, request, data, priority=PRIORITY_SEND, owner=None):
+        return self._submit(ScheduledRequest(
+            self, 'POST', request, data, priority, owner))
+
+    def _submit(self, pending):
+        if pending.shareable:
+            shared = self._share(pending)
+            if shared is not None:
+                self.coalesced += 1
+                return shared
+            self._inflight[pending.key] = pending
+        self._queues[pending.priority].append(pending)
+        self._dispatch()
+        return pending
+
+    def _share(self, pending):
+        """Return a request pending can piggyback on, if there is one
+        """
+        key = pending.key
+        cached = self._results.get(key)
+        if cached is not None:
+            expires, finished = cached
+            if expires > time.time():
+                copy = ScheduledRequest.fromFinished(self, finished)
+                mainloop.scheduler().idle(copy.finished.emit)
+                return copy
+            del self._results[key]
+
+        shared = self._inflight.get(key)
+        if shared is None:
+            return None
+        shared.owners.extend(pending.owners)
+        if pending.priority < shared.priority:
+            queue = self._queues[shared.priority]
+            if shared in queue:
+                queue.remove(shared)
+                shared.priority = pending.priority
+                self._queues[shared.priority].append(shared)
+                self._dispatch()
+        return shared
+
+    @property
+    def governor(self):
+        return self._governor
+
+    def _dispatch(self):
+        if self._wakeup is not None:
+            self._wakeup.cancel()
+            self._wakeup = None
+        wait = None
+        for priority in self._priorities:
+            queue = self._queues[priority]
+            active = self._active[priority]
+            limit = self._limits[priority]
+            while queue and (limit is None or len(active) < limit):
+                delay = self._governor.delay(priority)
+                if delay > 0:
+                    wait = delay if wait is None else min(wait, delay)
+                    break
+                self._start(queue.popleft())
+
+        if wait is not None:
+            self._wakeup = mainloop.scheduler().callLater(
+                int(wait * 1000) + 1, self._dispatch)
+
+    def _start(self, pending):
+        self._active[pending.priority].add(pending)
+        self._governor.started(pending.priority)
+        pending.startedAt = time.monotonic()
+        reply = pending._start(self._net)
+        reply.finished.connect(lambda: self._finished(pending))
+
+    def _finished(self, pending):
+        self._active[pending.priority].discard(pending)
+        reply = pending.reply
+        self._governor.update(reply)
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if status == 429 and not pending.cancelled:
+            # try again once the governor says the budget is back
+            self._queues[pending.priority].appendleft(pending)
+        else:
+            self._complete(pending, reply, status)
+        reply.deleteLater()
+        self._dispatch()
+
+    def _complete(self, pending, reply, status):
+        pending._drain()
+        if pending.shareable:
+            self._forgetInflight(pending)
+            body = pending.readAll()
+        else:
+            body = None
+        if pending._inflateError is not None:
+            pending._finish(QNetworkReply.ProtocolFailure,
+                            pending._inflateError, status, body)
+        else:
+            pending._finish(reply.error(), reply.errorString(), status, body)
+        if pending.priority != PRIORITY_STREAM:
+            endpoint = endpointName(pending._request.url())
+            _REQUEST_SECONDS.observe(time.monotonic() - pending.startedAt,
+                                     method=pending._operation, endpoint=endpoint)
+            _REQUESTS.inc(method=pending._operation, endpoint=endpoint,
+                          status=status or 0)
+        if pending.cancelled:
+            return
+
+        if (self._result_ttl and pending.shareable and
+                pending.error() == QNetworkReply.NoError):
+            self._cacheResult(pending)
+        pending.finished.emit()
+
+    def _forgetInflight(self, pending):
+        # a cancelled request can finish after a new one for the same
+        # key went out, which must stay shareable
+        if self._inflight.get(pending.key) is pending:
+            del self._inflight[pending.key]
+
+    def _cacheResult(self, pending):
+        now = time.time()
+        results = self._results
+        while results and next(iter(results.values()))[0] <= now:
+            results.popitem(last=False)
+        results.pop(pending.key, None)
+        results[pending.key] = (now + self._result_ttl, pending)
+        while len(results) > RESULT_CACHE_SIZE:
+            results.popitem(last=False)
+
+    def cancelRequest(self, pending):
+        pending._cancelled = True
+        if pending.shareable:
+            self._forgetInflight(pending)
+        try:
+            self._queues[pending.priority].remove(pending)
+        except ValueError:
+            if pending.reply is not None:
+                pending.reply.abort()
+
+    def cancel(self, owner):
+        """Drop every queued or running request made for owner
+
+        Requests shared with other owners keep going for them.
+        """
+        for priority in self._priorities:
+            requests = list(self._queues[priority]) + list(self._active[priority])
+            for pending in requests:
+                if owner in pending.owners:
+                    pending.owners = [o for o in pending.owners if o is not owner]
+                    if not pending.owners:
+                        self.cancelRequest(pending)
+
+    def _throttled(self, reason, delay):
+        _THROTTLED.inc(reason=reason)
+
+    def _collectMetrics(self):
+        account = self._account
+        for priority in self._priorities:
+            _QUEUE_DEPTH.set(len(self._queues[priority]),
+                             account=account, priority=priority)
+            _ACTIVE_REQUESTS.set(len(self._active[priority]),
+                                 account=account, priority=priority)
+        _TRANSFER_BYTES.set(self.stats.wire_bytes, account=account, stage='wire')
+        _TRANSFER_BYTES.set(self.stats.decoded_bytes,
+                            account=account, stage='decoded')
+
+    def queueDepth(self):
+        return {p: len(self._queues[p]) for p in self._priorities}
+
+    def status(self):
+        return {
+            'queue_depth': self.queueDepth(),
+            'active': {p: len(self._active[p]) for p in self._priorities},
+            'coalesced': self.coalesced,
+            'cached_results': len(self._results),
+            'rate_limit': self._governor.status(),
+            'transfer': self.stats.status(),
+        }
+
+
+def readResponseLater(resp, callback):
+    """Call callback with the decoded body of a finished reply
+
+    Successful bodies are decoded and normalized on the ingest thread,
+    so the callback always runs after this returns.
+    """
+    if isinstance(resp, ScheduledRequest):
+        resp.resultLater(callback)
+        return
+
+    data = resp.readAll()
+    if resp.error() == 0:
+        ingest().decode(data, callback)
     else:
-        logger.error('Error: %s', line)
+        callback(_decodeResponse(resp, data))
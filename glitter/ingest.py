@@ -0,0 +1,240 @@
+# telepathy-glitter - an Gitter connection manager for Telepathy
+#
+# Copyright (C) 2015 Diane Trout
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Decode and normalize gitter payloads off the main thread
+
+Reply bodies and stream lines are handed to a worker QThread as bytes
+and come back to the main thread, through a queued signal, as plain
+json records with their timestamps already parsed. Jobs finish in the
+order they were submitted.
+"""
+from PyQt5.QtCore import QCoreApplication, QObject, QThread, pyqtSignal, pyqtSlot
+
+import itertools
+import json
+import logging
+import re
+import time
+
+from glitter import codec
+
+__all__ = ['IngestWorker', 'Ingest', 'ingest', 'parseTimestamp']
+
+logger = logging.getLogger('Glitter.Ingest')
+
+# arrays at least this big are decoded an element at a time with the
+# stdlib backend, letting the interpreter switch back to the main
+# thread in between
+SPLIT_THRESHOLD = 64 * 1024
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def _daysFromCivil(year, month, day):
+    """Days since 1970-01-01 of a proleptic Gregorian date
+    """
+    year -= month <= 2
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def parseTimestamp(value):
+    """Return epoch milliseconds of a gitter timestamp
+
+    Gitter always sends UTC in the form 2015-08-18T05:16:11.123Z, so
+    the fields are read by position rather than through strptime.
+    """
+    if (len(value) < 20 or value[-1] != 'Z' or value[4] != '-' or
+            value[10] != 'T'):
+        raise ValueError("Unexpected timestamp {!r}".format(value))
+    days = _daysFromCivil(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+    seconds = (((days * 24 + int(value[11:13])) * 60 +
+                int(value[14:16])) * 60 + int(value[17:19]))
+    fraction = value[20:-1]
+    milliseconds = int((fraction + '000')[:3]) if fraction else 0
+    return seconds * 1000 + milliseconds
+
+
+def normalizeMessage(record):
+    """Add sent_ms and edited_ms to a chat message record
+    """
+    sent = record.get('sent')
+    record['sent_ms'] = parseTimestamp(sent) if sent else None
+    edited = record.get('editedAt')
+    record['edited_ms'] = parseTimestamp(edited) if edited else None
+    return record
+
+
+def normalize(obj):
+    """Normalize the chat messages in a decoded payload, in place
+
+    Messages in a list with timestamps that can't be parsed are left
+    out, rather than losing the whole page to one of them.
+    """
+    if isinstance(obj, list):
+        kept = []
+        for record in obj:
+            if isinstance(record, dict) and 'sent' in record:
+                try:
+                    normalizeMessage(record)
+                except (TypeError, ValueError) as e:
+                    logger.error("Skipping message %s: %s", record.get('id'), e)
+                    continue
+            kept.append(record)
+        obj[:] = kept
+    elif isinstance(obj, dict):
+        if 'sent' in obj:
+            normalizeMessage(obj)
+        # stream events wrap their payload in a model
+        elif isinstance(obj.get('model'), dict) and 'sent' in obj['model']:
+            normalizeMessage(obj['model'])
+    return obj
+
+
+def _decodeArray(text):
+    decoder = json.JSONDecoder()
+    items = []
+    pos = _WHITESPACE.match(text, 1).end()
+    while text[pos] != ']':
+        item, pos = decoder.raw_decode(text, pos)
+        items.append(item)
+        pos = _WHITESPACE.match(text, pos).end()
+        if text[pos] == ',':
+            pos = _WHITESPACE.match(text, pos + 1).end()
+    return items
+
+
+def decode(data):
+    """Decode a json body, splitting up large arrays for the stdlib backend
+    """
+    if (codec.BACKEND == 'json' and len(data) >= SPLIT_THRESHOLD and
+            data[:1] == b'['):
+        try:
+            return _decodeArray(data.decode('utf-8'))
+        except IndexError:
+            raise ValueError("Truncated json array")
+    return codec.loads(data)
+
+
+class IngestWorker(QObject):
+    """Lives on the ingest thread, turning bytes into records
+    """
+    # job id, decoded records or None
+    decoded = pyqtSignal(int, object)
+
+    @pyqtSlot(int, object, bool, float)
+    def process(self, job, data, lines, received):
+        try:
+            if lines:
+                result = []
+                for line in data:
+                    line = line.strip()
+                    if not line:
+                        # keepalive newlines on the stream
+                        continue
+                    try:
+                        record = normalize(codec.loads(line))
+                    except Exception as e:
+                        logger.error("Skipping undecodable stream line: %s", e)
+                        continue
+                    if isinstance(record, dict) and 'sent_ms' in record:
+                        # see glitter.util.latency
+                        record['trace'] = {'received': received,
+                                           'decoded': time.time()}
+                    result.append(record)
+            else:
+                result = normalize(decode(data))
+        except Exception as e:
+            # the callback is waiting on this job whatever went wrong
+            logger.error("Unable to decode %d bytes: %s", len(data), e)
+            result = None
+        self.decoded.emit(job, result)
+
+
+class Ingest(QObject):
+    """Main thread side of the ingest thread
+
+    Callbacks are called on the main thread with the records.
+    """
+    _submit = pyqtSignal(int, object, bool, float)
+
+    def __init__(self):
+        super().__init__()
+        self._jobs = itertools.count()
+        self._callbacks = {}
+        self.submitted = 0
+        self.submittedBytes = 0
+
+        self._thread = QThread()
+        self._thread.setObjectName('glitter-ingest')
+        self._worker = IngestWorker()
+        self._worker.moveToThread(self._thread)
+        self._submit.connect(self._worker.process)
+        self._worker.decoded.connect(self._decoded)
+        self._thread.start()
+
+        app = QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.stop)
+
+    def decode(self, data, callback):
+        """Decode a whole reply body and pass the result to callback
+        """
+        self._queue(bytes(data), False, callback)
+
+    def decodeLines(self, lines, callback):
+        """Decode stream lines and pass the list of events to callback
+        """
+        self._queue([bytes(line) for line in lines], True, callback)
+
+    def _queue(self, data, lines, callback):
+        job = next(self._jobs)
+        self._callbacks[job] = callback
+        self.submitted += 1
+        self.submittedBytes += (sum(len(line) for line in data)
+                                if lines else len(data))
+        self._submit.emit(job, data, lines, time.time())
+
+    def _decoded(self, job, result):
+        self._callbacks.pop(job)(result)
+
+    def stop(self):
+        self._thread.quit()
+        self._thread.wait()
+
+    def status(self):
+        return {
+            'pending': len(self._callbacks),
+            'submitted': self.submitted,
+            'submitted_bytes': self.submittedBytes,
+        }
+
+
+_ingest = None
+
+
+def ingest():
+    """Return the process wide Ingest, starting its thread on first use
+    """
+    global _ingest
+    if _ingest is None:
+        _ingest = Ingest()
+    return _ingest
@@ -0,0 +1,193 @@
+# telepathy-glitter - an Gitter connection manager for Telepathy
+#
+# Copyright (C) 2015 Diane Trout
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import collections
+import logging
+import time
+import uuid
+
+from PyQt5.QtCore import QObject, pyqtSignal
+from PyQt5.QtNetwork import QNetworkReply, QNetworkRequest
+
+from glitter.util import mainloop, metrics
+from glitter.util.storage import account_filename, read_json, write_json
+
+__all__ = ['Outbox']
+
+logger = logging.getLogger('Glitter.Outbox')
+
+# ms to wait before retrying a room whose send failed for lack of network
+RETRY_INTERVAL = 30000
+
+_OUTBOX_DEPTH = metrics.registry().gauge(
+    'glitter_outbox_pending', 'Messages waiting to be sent',
+    ['account', 'room'])
+
+
+# refusals a reconnect or the next room refresh may clear, like an
+# expired token. The scheduler retries 429s itself
+HELD_STATUSES = frozenset([401, 403])
+
+
+def _transient(status):
+    """True if a failed send is worth retrying later
+    """
+    # no status means we never got an answer from the server
+    return status is None or status == 408 or status >= 500
+
+
+class Outbox(QObject):
+    """Messages waiting to be posted, kept on disk until gitter has them
+
+    Each room's messages are sent one at a time so they arrive in the
+    order they were written, while all rooms flush at once. The posts
+    go through the request scheduler, which holds them back when the
+    rate limit runs low and retries them when it runs out. A send that
+    fails for lack of network stays at the head of its room's queue and
+    is retried. One refused for authorization is held there until the
+    next flush. Either is reported as a temporary failure only once.
+    """
+    def __init__(self, account):
+        super().__init__()
+        self._account = account
+        self._filename = account_filename('outbox', account)
+        # room name -> deque of {'token', 'text', 'queued'}
+        self._queues = {
+            name: collections.deque(entries)
+            for name, entries in read_json(self._filename, {}).items()}
+        self._sending = {}
+        self._retrying = set()
+        # rooms waiting for the next flush after a refused send
+        self._held = set()
+        # tokens already reported as temporarily failed
+        self._reported = set()
+        self._rooms = None
+        metrics.registry().addCollector(self._collectMetrics)
+
+    # room name, delivery token, gitter message id
+    delivered = pyqtSignal(str, str, str)
+    # room name, delivery token, permanent, error message
+    failed = pyqtSignal(str, str, bool, str)
+
+    def attach(self, rooms):
+        """Start sending through rooms and flush anything queued
+        """
+        self._rooms = rooms
+        self.flush()
+
+    def detach(self):
+        """Keep queueing messages without sending them
+        """
+        self._rooms = None
+
+    def queue(self, name, text):
+        """Queue text for the room called name, returning its delivery token
+        """
+        token = uuid.uuid4().hex
+        self._queues.setdefault(name, collections.deque()).append(
+            {'token': token, 'text': text, 'queued': time.time()})
+        self._save()
+        self._flushRoom(name)
+        return token
+
+    def pending(self, name):
+        """Return the number of messages waiting for a room
+        """
+        return len(self._queues.get(name, ()))
+
+    def flush(self):
+        self._held.clear()
+        for name in list(self._queues):
+            self._flushRoom(name)
+
+    def _flushRoom(self, name):
+        if (self._rooms is None or name in self._sending or
+                name in self._retrying or name in self._held):
+            return
+        queue = self._queues.get(name)
+        if not queue:
+            self._queues.pop(name, None)
+            return
+
+        room = self._rooms.get(name)
+        if room is None:
+            if self._rooms.live:
+                # we've left the room, nothing queued for it can be sent
+                while queue:
+                    self._drop(name, queue[0], 'Not a member of ' + name)
+            return
+
+        entry = queue[0]
+        reply = room.sendMessage(entry['text'])
+        self._sending[name] = reply
+        reply.finished.connect(lambda: self._sent(name, entry, reply))
+
+    def _sent(self, name, entry, reply):
+        del self._sending[name]
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if reply.error() == QNetworkReply.NoError:
+            self._queues[name].popleft()
+            self._save()
+            message = reply.result() or {}
+            self._reported.discard(entry['token'])
+            self.delivered.emit(name, entry['token'], message.get('id', ''))
+        elif _transient(status):
+            logger.info("Send to %s failed, will retry: %s",
+                        name, reply.errorString())
+            self._failedTemporarily(name, entry, reply.errorString())
+            self._retry(name)
+            return
+        elif status in HELD_STATUSES:
+            logger.info("Send to %s refused with %d, holding it until the "
+                        "next flush: %s", name, status, reply.errorString())
+            self._failedTemporarily(name, entry, reply.errorString())
+            self._held.add(name)
+            return
+        else:
+            self._drop(name, entry, reply.errorString())
+        self._flushRoom(name)
+
+    def _drop(self, name, entry, error):
+        logger.warning("Dropping message to %s: %s", name, error)
+        self._queues[name].remove(entry)
+        self._save()
+        self._reported.discard(entry['token'])
+        self.failed.emit(name, entry['token'], True, error)
+
+    def _failedTemporarily(self, name, entry, error):
+        # every report stays pending on the channel, so one is enough
+        if entry['token'] not in self._reported:
+            self._reported.add(entry['token'])
+            self.failed.emit(name, entry['token'], False, error)
+
+    def _retry(self, name):
+        def retry():
+            self._retrying.discard(name)
+            self._flushRoom(name)
+        self._retrying.add(name)
+        mainloop.scheduler().callLater(RETRY_INTERVAL, retry)
+
+    def _collectMetrics(self):
+        # other accounts' outboxes share the gauge
+        _OUTBOX_DEPTH.clear(account=self._account)
+        for name, queue in self._queues.items():
+            _OUTBOX_DEPTH.set(len(queue), account=self._account, room=name)
+
+    def _save(self):
+        write_json(self._filename, {
+            name: list(queue) for name, queue in self._queues.items() if queue})
@@ -23,8 +23,6 @@ import telepathy
 
 # import gitter interfaces
 
-from glitter.connection import GlitterConnection
-
 __all__ = ['GlitterProtocol']
 
 logger = logging.getLogger('Glitter.Protocol')
@@ -84,4 +82,7 @@ class GlitterProtocol(
         telepathy.server.ProtocolInterfacePresence.__init__(self)
 
     def create_connection(self, connection_manager, parameters):
+        # the connection drags in Qt networking and every channel type,
+        # none of which is needed until an account connects
+        from glitter.connection import GlitterConnection
         return GlitterConnection(self, connection_manager, parameters)
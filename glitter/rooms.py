@@ -1,24 +1,46 @@
 import configparser
 import logging
 import os
-from pprint import pformat
+import time
 import datetime
-import json
 import collections
-import pytz
+import collections.abc
 
 from PyQt5.QtCore import (
-    QUrl, QUrlQuery, QTimer, QObject, pyqtSlot, pyqtSignal, QStandardPaths
+    QUrl, QUrlQuery, QObject, pyqtSlot, pyqtSignal, QStandardPaths
 )
 from PyQt5.QtNetwork import QNetworkAccessManager, QNetworkRequest
-from .grequests import makeRequest, readResponse, readLongResponse
+from . import codec
+from .ingest import ingest, parseTimestamp
+from .util import mainloop, metrics, tracing
+from .grequests import (
+    RequestTemplate, readResponse, readResponseLater, readLines,
+    RequestScheduler,
+    PRIORITY_SEND, PRIORITY_HISTORY, PRIORITY_BACKFILL, PRIORITY_REFRESH,
+    PRIORITY_STREAM
+)
 
 logger = logging.getLogger(__name__)
 
 GITTER_SERVER = 'gitter.im'
 API_VERSION = '/v1/'
-GITTER_API = 'https://api.' + GITTER_SERVER + API_VERSION
-GITTER_STREAM = 'https://stream.' + GITTER_SERVER + API_VERSION
+# the environment can point these somewhere else, like the stand-in
+# server in benchmarks/fakegitter.py. Both must end with a /
+GITTER_API = os.environ.get(
+    'GITTER_API', 'https://api.' + GITTER_SERVER + API_VERSION)
+GITTER_STREAM = os.environ.get(
+    'GITTER_STREAM', 'https://stream.' + GITTER_SERVER + API_VERSION)
+
+# milliseconds between checks that the api and stream connections
+# are still open
+KEEPALIVE_INTERVAL = 60000
+REFRESH_INTERVAL = 600000
+
+_MESSAGES_INGESTED = metrics.registry().counter(
+    'glitter_messages_ingested_total', 'New chat messages stored', ['room'])
+_STREAM_RECONNECTS = metrics.registry().counter(
+    'glitter_stream_reconnects_total', 'Streams reopened after ending',
+    ['stream'])
 
 class GitterObject(QObject):
     def __init__(self):
@@ -32,41 +54,81 @@ class GitterObject(QObject):
 
 
 class Rooms(GitterObject):
-    def __init__(self, net, auth, manager):
+    def __init__(self, scheduler, template, manager):
         super().__init__()
-        self._net = net
-        self._auth = auth.encode('utf-8')
+        self._scheduler = scheduler
+        self._template = template
+        self._url = QUrl(GITTER_API + "rooms/")
         self._manager = manager
         self._rooms = {}
+        # room name -> json it was last read from
+        self._json = {}
+        # set once a listing from the server has been read
+        self.live = False
 
-        QTimer().singleShot(0, self.load)
+        mainloop.scheduler().idle(self.load)
 
     ready = pyqtSignal()
+    # added, removed and updated room names
+    changed = pyqtSignal(list, list, list)
 
     def load(self):
         logger.debug("load %d", len(self._rooms))
-        url = QUrl(GITTER_API + "rooms/")
-        req = makeRequest(url, self._auth)
-        resp = self._net.get(req)
-        resp.readyRead.connect(lambda: self.readResponse(resp))
+        req = self._template.request(self._url)
+        resp = self._scheduler.get(req, PRIORITY_REFRESH, owner=self)
+        resp.finished.connect(lambda: self.readResponse(resp))
 
     @pyqtSlot()
     def readResponse(self, resp):
-        rooms = readResponse(resp)
+        readResponseLater(resp, self.readRooms)
+
+    def readRooms(self, rooms, live=True):
+        """Create or update rooms from a listing
+
+        A listing from the server also drops rooms no longer in it,
+        the cached listing from a snapshot only ever adds rooms.
+        Once rooms are known, changed reports what a listing altered.
+        """
+        if rooms is None:
+            return
+        known = bool(self._rooms)
+        added = []
+        updated = []
         for roomjson in rooms:
             name = roomjson['name']
             if name in self._rooms:
-                # update attributes
-                self._rooms[name].readJson(roomjson)
+                if roomjson != self._json[name]:
+                    # update attributes
+                    self._rooms[name].readJson(roomjson)
+                    updated.append(name)
             else:
                 # create new room
-                self._rooms[name] = Room(self._net, self._auth, json=roomjson)
-            logger.debug('Room: %s %d messages',
-                         name,
-                         len(self._rooms[name].messages))
+                self._rooms[name] = Room(self._scheduler, self._template, json=roomjson)
+                added.append(name)
+            self._json[name] = roomjson
+
+        removed = []
+        if live:
+            self.live = True
+            listed = set(roomjson['name'] for roomjson in rooms)
+            removed = [name for name in self._rooms if name not in listed]
+            for name in removed:
+                self._rooms.pop(name).disconnect()
+                del self._json[name]
+
+        logger.debug('Rooms: %d added, %d removed, %d updated',
+                     len(added), len(removed), len(updated))
         self.ready.emit()
+        if known and (added or removed or updated):
+            self.changed.emit(added, removed, updated)
+
+    def snapshot(self):
+        """Return the room json objects as last read
+        """
+        return list(self._json.values())
 
     def disconnect(self):
+        self._scheduler.cancel(self)
         for room in self._rooms:
             self._rooms[room].disconnect()
 
@@ -93,7 +155,7 @@ class Rooms(GitterObject):
         return self._rooms.values()
 
     def get(self, key, value=None):
-        return self.get(key, value)
+        return self._rooms.get(key, value)
 
     def __eq__(self, other):
         return self._rooms == other
@@ -104,18 +166,23 @@ class Rooms(GitterObject):
 
 ROOM_ATTRIBUTES = ['id', 'name', 'topic', 'uri', 'oneToOne',
                    'users', 'userCount', 'unreadItems', 'mentions',
-                   'lastAccessTime', 'lurk', 'url', 'githubType', 'v']
+                   'lastAccessTime', 'lurk', 'url', 'githubType', 'v',
+                   'user', 'avatarUrl', 'avatarUrlSmall', 'avatarUrlMedium']
 
 
 class Room(GitterObject):
     __last_message_attribute = 'last_message_id'
 
-    def __init__(self, net, auth, json=None):
+    def __init__(self, scheduler, template, json=None):
         super().__init__()
-        self._net = net
-        self._auth = auth
+        self._scheduler = scheduler
+        self._template = template
+        # (base, path, room id) -> QUrl
+        self._urls = {}
         self._messages = Messages(self)
         self._events = None
+        self._userEvents = None
+        self._usersSkip = 0
 
         self.id = None
         self.name = None
@@ -131,6 +198,10 @@ class Room(GitterObject):
         self.url = None
         self.githubType = None
         self.v = None
+        self.user = None
+        self.avatarUrl = None
+        self.avatarUrlSmall = None
+        self.avatarUrlMedium = None
 
         if json:
             self.readJson(json)
@@ -143,6 +214,10 @@ class Room(GitterObject):
     messageSent = pyqtSignal(str)
     newEarliestMessage = pyqtSignal(str)
     newLatestMessage = pyqtSignal(str)
+    # page of user json objects, True if more pages remain
+    usersLoaded = pyqtSignal(list, bool)
+    userJoined = pyqtSignal(object)
+    userLeft = pyqtSignal(object)
 
     @property
     def config(self):
@@ -167,6 +242,32 @@ class Room(GitterObject):
     def __str__(self):
         return self.name
 
+    @property
+    def preferredAvatarUrl(self):
+        """Return the best avatar url for this room
+
+        One to one rooms use the avatar of the other user.
+        """
+        user = self.user or {}
+        return (self.avatarUrlMedium or
+                self.avatarUrlSmall or
+                user.get('avatarUrlMedium') or
+                user.get('avatarUrlSmall') or
+                self.avatarUrl)
+
+    def endpoint(self, base, path):
+        """Return the QUrl of one of this room's endpoints
+
+        The urls are built once per room, QUrl is implicitly shared so
+        callers adding a query get their own copy.
+        """
+        key = (base, path, self.id)
+        url = self._urls.get(key)
+        if url is None:
+            url = QUrl(base + path.format(self.id))
+            self._urls[key] = url
+        return url
+
     def loadLastMessageId(self):
         config = self.config
         if self.name in config:
@@ -181,11 +282,10 @@ class Room(GitterObject):
         with open(self.configFilename, 'wt') as outstream:
             config.write(outstream)
 
-    def loadMessages(self, skip=None, beforeId=None, afterId=None, limit=50):
+    def loadMessages(self, skip=None, beforeId=None, afterId=None, limit=50,
+                     priority=PRIORITY_HISTORY):
         logger.debug("listMessages")
-        url = QUrl(
-            GITTER_API + "/rooms/{}/chatMessages".format(self.id)
-        )
+        url = QUrl(self.endpoint(GITTER_API, "rooms/{}/chatMessages"))
         query = QUrlQuery()
         if skip:
             query.addQueryItem("skip", str(skip))
@@ -194,18 +294,20 @@ class Room(GitterObject):
         if afterId:
             query.addQueryItem("afterId", str(afterId))
         elif self._messages.last_id:
-            query.addQueryItem("afterId", str(self._messages.last_id()))
+            query.addQueryItem("afterId", str(self._messages.last_id))
         if limit:
             query.addQueryItem("limit", str(limit))
 
         url.setQuery(query)
-        req = makeRequest(url, self._auth)
-        reply = self._net.get(req)
+        req = self._template.request(url)
+        reply = self._scheduler.get(req, priority, owner=self)
         reply.finished.connect(lambda: self.readMessages(reply))
 
     @pyqtSlot()
     def readMessages(self, reply):
-        messages = readResponse(reply)
+        readResponseLater(reply, self.addMessages)
+
+    def addMessages(self, messages):
         if messages:
             new_messages = []
             for json_message in messages:
@@ -213,50 +315,118 @@ class Room(GitterObject):
                 if message.id not in self._messages:
                     self._messages[message.id] = message
                     new_messages.append(message.id)
-            self.messagesReceived.emit(new_messages)
+                    if message.trace is not None:
+                        message.trace['stored'] = time.time()
+            if tracing.enabled:
+                tracing.record('room.messages', self.name, len(messages),
+                               len(new_messages))
+            if new_messages:
+                _MESSAGES_INGESTED.inc(len(new_messages), room=self.name)
+            for message_id in new_messages:
+                self.messagesReceived.emit(message_id)
 
     def startMessageStream(self):
         """Open a socket to this room and listen for events
         """
         logger.debug("startMessageStream")
-        url = QUrl(
-            GITTER_STREAM + "rooms/{}/chatMessages".format(self.id)
-        )
-        req = makeRequest(url, self._auth)
-        self._events = self._net.get(req)
+        req = self._template.request(
+            self.endpoint(GITTER_STREAM, "rooms/{}/chatMessages"))
+        self._events = self._scheduler.get(req, PRIORITY_STREAM, owner=self)
         self._events.readyRead.connect(
             lambda: self.receiveMessageStream(self._events))
-        self._events.finished.connect(self.startMessageStream)
+        self._events.finished.connect(self.restartMessageStream)
+
+    def restartMessageStream(self):
+        _STREAM_RECONNECTS.inc(stream='chatMessages')
+        self.startMessageStream()
 
     def receiveMessageStream(self, response):
-        """Receive an event from the socket
+        """Hand the lines received on the socket to the ingest thread
+        """
+        lines = readLines(response)
+        if lines:
+            if tracing.enabled:
+                tracing.record('stream.lines', self.name, len(lines))
+            ingest().decodeLines(lines, self.addMessages)
+
+    def loadUsers(self, limit=100):
+        """Request the next page of room members
+
+        Each page is announced with usersLoaded, call again to continue
+        with the following page.
         """
-        json_message = readLongResponse(response)
-        if json_message:
-            logger.debug('receiveMessage: %s', pformat(json_message))
-            message = Message(json=json_message)
-            if message.id not in self._messages:
-                self._messages[message.id] = message
-                self.messagesReceived.emit(message.id)
+        logger.debug("loadUsers %s skip=%d", self.name, self._usersSkip)
+        url = QUrl(self.endpoint(GITTER_API, "rooms/{}/users"))
+        query = QUrlQuery()
+        query.addQueryItem("skip", str(self._usersSkip))
+        query.addQueryItem("limit", str(limit))
+        url.setQuery(query)
+        req = self._template.request(url)
+        # the first page is what a client opening the room waits for
+        if self._usersSkip == 0:
+            priority = PRIORITY_HISTORY
+        else:
+            priority = PRIORITY_BACKFILL
+        reply = self._scheduler.get(req, priority, owner=self)
+        reply.finished.connect(lambda: self.readUsers(reply, limit))
+
+    @pyqtSlot()
+    def readUsers(self, reply, limit):
+        users = readResponse(reply) or []
+        self._usersSkip += len(users)
+        self.usersLoaded.emit(users, len(users) == limit)
+
+    def startUserStream(self):
+        """Listen for members joining and leaving this room
+        """
+        logger.debug("startUserStream")
+        req = self._template.request(
+            self.endpoint(GITTER_STREAM, "rooms/{}/users"))
+        self._userEvents = self._scheduler.get(
+            req, PRIORITY_STREAM, owner=self)
+        self._userEvents.readyRead.connect(
+            lambda: self.receiveUserStream(self._userEvents))
+        self._userEvents.finished.connect(self.restartUserStream)
+
+    def restartUserStream(self):
+        _STREAM_RECONNECTS.inc(stream='users')
+        self.startUserStream()
+
+    def receiveUserStream(self, response):
+        lines = readLines(response)
+        if lines:
+            ingest().decodeLines(lines, self.receiveUserEvents)
+
+    def receiveUserEvents(self, events):
+        for event in events:
+            operation = event.get('operation')
+            if operation == 'create':
+                self.userJoined.emit(event['model'])
+            elif operation == 'remove':
+                self.userLeft.emit(event['model'])
 
     def disconnect(self):
         logger.debug("disconnect")
-        if isinstance(self._events, QNetworkRequest):
-            self._events.abort()
-            self._events.finished.disconnect(self.startEventStream)
+        # cancelled requests never finish, so the streams stay closed
+        self._scheduler.cancel(self)
+        self._events = None
+        self._userEvents = None
+        self._usersSkip = 0
         self.saveLastMessageId()
 
     def sendMessage(self, text):
-        url = QUrl(
-            GITTER_API + "rooms/{}/chatMessages".format(self.id)
-        )
+        """Post a message, returning the pending request
+        """
         body = {'text': text}
-        message = json.dumps(body)
+        message = codec.dumps(body)
         logger.debug('sendMessage: %s', message)
-        req = makeRequest(url, self._auth)
-        req.setRawHeader('Content-Type', 'application/json')
-        reply = self._net.post(req, message)
+        req = self._template.jsonRequest(
+            self.endpoint(GITTER_API, "rooms/{}/chatMessages"))
+        # not owned by the room, a closing channel shouldn't drop
+        # something the user already typed
+        reply = self._scheduler.post(req, message, PRIORITY_SEND)
         reply.finished.connect(lambda: self.sentMessage(reply))
+        return reply
 
     @pyqtSlot()
     def sentMessage(self, reply):
@@ -271,7 +441,7 @@ class Room(GitterObject):
         return self._messages
 
 
-class Messages(collections.MutableMapping):
+class Messages(collections.abc.MutableMapping):
     def __init__(self, room):
         super().__init__()
         self._room = room
@@ -287,11 +457,14 @@ class Messages(collections.MutableMapping):
     def __setitem__(self, key, value):
         if not isinstance(value, Message):
             raise ValueError("We only store Messages")
-        if self._latest_id is None or value.sent_timestamp > self._latest_timestamp:
+        sent = value.sent_ms
+        if self._latest_id is None or sent > self._latest_timestamp:
             self._latest_id = value.id
+            self._latest_timestamp = sent
             self._room.newLatestMessage.emit(self._latest_id)
-        if self._earliest_id is None or value.sent_timestamp < self._earliest_timestamp:
+        if self._earliest_id is None or sent < self._earliest_timestamp:
             self._earliest_id = value.id
+            self._earliest_timestamp = sent
             self._room.newEarliestMessage.emit(self._earliest_id)
         self._messages[key] = value
 
@@ -313,6 +486,12 @@ class Messages(collections.MutableMapping):
         return self._earliest_id
 
 
+def _utcFromMs(ms):
+    if ms is not None:
+        return datetime.datetime.fromtimestamp(ms / 1000,
+                                               datetime.timezone.utc)
+
+
 class Message(GitterObject):
     def __init__(self, json=None):
         super().__init__()
@@ -320,8 +499,9 @@ class Message(GitterObject):
         self.id = None
         self.text = None
         self.html = None
-        self.sent = None
-        self.editedAt = None
+        # epoch milliseconds of sent and editedAt
+        self.sent_ms = None
+        self.edited_ms = None
         self.fromUser = None
         self.unread = None
         self.readBy = None
@@ -330,6 +510,8 @@ class Message(GitterObject):
         self.issues = None
         self.meta = None
         self.v = None
+        # stage times of streamed messages, see glitter.util.latency
+        self.trace = None
 
         if json:
             self.loadJson(json)
@@ -337,48 +519,90 @@ class Message(GitterObject):
     ready = pyqtSignal()
 
     def loadJson(self, json):
-        isoformat = "%Y-%m-%dT%H:%M:%S.%fZ"
-        utc = pytz.timezone('UTC')
         for key in json:
             value = json[key]
-            if key in ('sent', 'editedAt') and value is not None:
-                value = datetime.datetime.strptime(value, isoformat)
-                value = utc.localize(value)
-            self.safesetattr(key, value)
+            if key == 'sent':
+                # the ingest thread usually parsed it already
+                if 'sent_ms' not in json:
+                    self.sent_ms = parseTimestamp(value) if value else None
+            elif key == 'editedAt':
+                if 'edited_ms' not in json:
+                    self.edited_ms = parseTimestamp(value) if value else None
+            else:
+                self.safesetattr(key, value)
         self.ready.emit()
-        print(self.sent, self.text)
+
+    @property
+    def sent(self):
+        return _utcFromMs(self.sent_ms)
+
+    @property
+    def editedAt(self):
+        return _utcFromMs(self.edited_ms)
 
     @property
     def sent_timestamp(self):
-        if self.sent:
-            return int(self.sent.timestamp())
+        if self.sent_ms is not None:
+            return self.sent_ms // 1000
 
 
 class GitterClient(QObject):
     """Manage a connection to Gitter
     """
-    def __init__(self, manager, auth):
+    def __init__(self, manager, auth, account=''):
         super().__init__()
         self._manager = manager
         self._auth = auth
         self._rooms = None
         self._net = QNetworkAccessManager()
+        # overlapping refreshes and history requests within a couple of
+        # seconds of each other share one reply
+        self._scheduler = RequestScheduler(self._net, result_ttl=2,
+                                           account=account)
+        self._template = RequestTemplate(auth.encode('utf-8'))
         self._rooms = None
         self._user = None
-        self._refresh_timer = None
+        self._refresh_job = None
+        self._keepalive_job = None
 
     connected = pyqtSignal()
     disconnected = pyqtSignal()
 
-    def connect(self):
-        if self._refresh_timer is None:
-            self._refresh_timer = QTimer()
-            self._refresh_timer.timeout.connect(self.refresh_client)
+    def connect(self, snapshot=None):
+        """Start talking to gitter
 
-        if not self._refresh_timer.isActive():
-            self._rooms = Rooms(self._net, self._auth, self._manager)
+        Parameters:
+          snapshot: room json saved from an earlier session, if given
+            connected is emitted from it before the server replies.
+        """
+        self.warmConnections()
+        if self._keepalive_job is None:
+            # Qt drops idle connections after a couple of minutes, well
+            # before the next rooms refresh
+            self._keepalive_job = mainloop.scheduler().callEvery(
+                KEEPALIVE_INTERVAL, self.warmConnections)
+
+        if self._refresh_job is None:
+            self._rooms = Rooms(self._scheduler, self._template, self._manager)
             self._rooms.ready.connect(self.rooms_initialized)
-            self._refresh_timer.start(600000)
+            self._refresh_job = mainloop.scheduler().callEvery(
+                REFRESH_INTERVAL, self.refresh_client)
+            if snapshot:
+                self._rooms.readRooms(snapshot, live=False)
+
+    def warmConnections(self):
+        """Open connections to the api and stream hosts ahead of use
+
+        The DNS, TCP and TLS setup for both hosts then happens in
+        parallel instead of serially in front of the first requests.
+        Hosts already connected are left alone.
+        """
+        for base in (GITTER_API, GITTER_STREAM):
+            url = QUrl(base)
+            if url.scheme() == 'https':
+                self._net.connectToHostEncrypted(url.host(), url.port(443))
+            else:
+                self._net.connectToHost(url.host(), url.port(80))
 
     def refresh_client(self):
         # really should check to see if changed?
@@ -390,9 +614,22 @@ class GitterClient(QObject):
         self._rooms.ready.disconnect(self.rooms_initialized)
 
     def disconnect(self):
-        self._refresh_timer.stop()
+        if self._keepalive_job is not None:
+            self._keepalive_job.cancel()
+            self._keepalive_job = None
+        if self._refresh_job is not None:
+            self._refresh_job.cancel()
+            self._refresh_job = None
         self._rooms.disconnect()
 
     @property
     def rooms(self):
         return self._rooms
+
+    @property
+    def network(self):
+        return self._net
+
+    @property
+    def scheduler(self):
+        return self._scheduler
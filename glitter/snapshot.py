@@ -0,0 +1,163 @@
+# telepathy-glitter - an Gitter connection manager for Telepathy
+#
+# Copyright (C) 2015 Diane Trout
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+import json
+import logging
+import os
+
+from glitter.util import mainloop
+from glitter.util.storage import account_filename, read_json, write_json
+
+__all__ = ['Snapshot', 'HandleStore']
+
+logger = logging.getLogger('Glitter.Snapshot')
+
+SNAPSHOT_VERSION = 1
+
+
+class Snapshot(object):
+    """Last room listing seen for an account
+
+    Lets Connect publish the contact list straight away and reconcile
+    it with the live listing once that arrives.
+    """
+    def __init__(self, account):
+        self._filename = account_filename('snapshots', account)
+
+    def load(self):
+        """Return the saved room json objects, or None without a snapshot
+        """
+        snapshot = read_json(self._filename)
+        if not snapshot or snapshot.get('version') != SNAPSHOT_VERSION:
+            return None
+        logger.debug("Loaded %d rooms from %s",
+                     len(snapshot['rooms']), self._filename)
+        return snapshot['rooms']
+
+    def save(self, rooms):
+        write_json(self._filename, {
+            'version': SNAPSHOT_VERSION,
+            'rooms': rooms,
+        })
+
+
+class HandleStore(object):
+    """Handle numbers assigned to an account's contacts
+
+    A name keeps the number it was first given across restarts, so
+    clients may cache per-handle data between connections. New names
+    are numbered after the highest id ever assigned.
+
+    Only names assigned with persist are kept, which are the account's
+    rooms. Room members come and go by the thousand, so they are
+    numbered for the session alone and dropped from the map if an
+    earlier version stored them.
+
+    New numbers are appended to a journal as they are handed out, so
+    a burst of them doesn't rewrite every id known. save() folds the
+    journal back into the id map.
+    """
+    def __init__(self, account):
+        self._filename = account_filename('handles', account)
+        self._journal = os.path.splitext(self._filename)[0] + '.journal'
+        stored = read_json(self._filename, {})
+        # handle type -> name -> id
+        self._ids = {int(handle_type): names
+                     for handle_type, names in stored.items()}
+        replayed = self._replayJournal()
+        # (handle type, name) -> id of names not kept across sessions
+        self._session_ids = {}
+        self._next_id = 1 + max(
+            (i for names in self._ids.values() for i in names.values()),
+            default=0)
+        # (handle type, name, id) not journaled yet
+        self._unwritten = []
+        # a journal left from last time gets folded in on the next save
+        self._dirty = replayed > 0
+
+    def _replayJournal(self):
+        """Apply the journal to the id map, returning how many entries it had
+        """
+        try:
+            with open(self._journal, 'rb') as instream:
+                lines = instream.read().decode('utf-8').splitlines()
+        except FileNotFoundError:
+            return 0
+        for line in lines:
+            try:
+                handle_type, name, handle_id = json.loads(line)
+            except ValueError:
+                # the tail of a write cut short
+                logger.warning("Skipping corrupt line in %s", self._journal)
+                continue
+            self._ids.setdefault(handle_type, {})[name] = handle_id
+        return len(lines)
+
+    def next_id(self):
+        handle_id = self._next_id
+        self._next_id += 1
+        return handle_id
+
+    def assign(self, handle_type, name, persist=True):
+        """Return the id for name, numbering it if it is new
+        """
+        names = self._ids.setdefault(handle_type, {})
+        if not persist:
+            handle_id = names.pop(name, None)
+            if handle_id is not None:
+                # stored before only rooms were kept
+                self._dirty = True
+            else:
+                handle_id = self._session_ids.get((handle_type, name))
+            if handle_id is None:
+                handle_id = self.next_id()
+            self._session_ids[handle_type, name] = handle_id
+            return handle_id
+        handle_id = names.get(name)
+        if handle_id is None:
+            handle_id = names[name] = self.next_id()
+            self._dirty = True
+            if not self._unwritten:
+                # append once per burst of new handles
+                mainloop.scheduler().idle(self._appendJournal)
+            self._unwritten.append((handle_type, name, handle_id))
+        return handle_id
+
+    def _appendJournal(self):
+        if not self._unwritten:
+            return
+        with open(self._journal, 'ab') as outstream:
+            outstream.write(''.join(
+                json.dumps(entry) + '\n' for entry in self._unwritten
+            ).encode('utf-8'))
+        self._unwritten = []
+
+    def save(self):
+        """Write the whole id map and start a fresh journal
+        """
+        if self._dirty:
+            logger.debug("Saving %d handles to %s",
+                         sum(len(names) for names in self._ids.values()),
+                         self._filename)
+            write_json(self._filename, self._ids)
+            self._unwritten = []
+            try:
+                os.unlink(self._journal)
+            except FileNotFoundError:
+                pass
+            self._dirty = False
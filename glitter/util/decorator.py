@@ -18,13 +18,12 @@
 #
 
 """Useful decorators"""
-from PyQt5.QtCore import QTimer
-
 import sys
 import warnings
-import time
 
-__all__ = ['decorator', 'rw_property', 'deprecated', 'unstable', 'async',
+from glitter.util import mainloop
+
+__all__ = ['decorator', 'rw_property', 'deprecated', 'unstable', 'asynchronous',
         'throttled']
 
 
@@ -78,47 +77,29 @@ def unstable(func):
     return new_function
 
 @decorator
-def async(func):
+def asynchronous(func):
     """Make a function mainloop friendly. the function will be called at the
     next mainloop idle state."""
     def new_function(*args, **kwargs):
-        def async_function():
-            func(*args, **kwargs)
-            return False
-        QTimer().singleShot(0, async_function)
+        mainloop.scheduler().idle(func, *args, **kwargs)
     return new_function
 
 class throttled(object):
     """Throttle the calls to a function by queueing all the calls that happen
-    before the minimum delay."""
+    before the minimum delay. Functions throttled under the same name share
+    one queue."""
 
-    def __init__(self, min_delay, queue):
+    def __init__(self, min_delay, name=None):
         self._min_delay = min_delay
-        self._queue = queue
-        self._last_call_time = None
+        self._name = name
 
     def __call__(self, func):
-        def process_queue():
-            if len(self._queue) != 0:
-                func, args, kwargs = self._queue.pop(0)
-                self._last_call_time = time.time() * 1000
-                func(*args, **kwargs)
-            return False
+        name = self._name or func.__qualname__
 
         def new_function(*args, **kwargs):
-            now = time.time() * 1000
-            if self._last_call_time is None or \
-                    now - self._last_call_time >= self._min_delay:
-                self._last_call_time = now
-                func(*args, **kwargs)
-            else:
-                self._queue.append((func, args, kwargs))
-                last_call_delta = now - self._last_call_time
-                process_queue_timeout = int(self._min_delay * len(self._queue) - last_call_delta)
-                QTimer().singleShot(process_queue_timeout, process_queue)
+            mainloop.scheduler().throttle(name, self._min_delay, func, *args, **kwargs)
 
         new_function.__name__ = func.__name__
         new_function.__doc__ = func.__doc__
         new_function.__dict__.update(func.__dict__)
         return new_function
-
@@ -0,0 +1,120 @@
+# telepathy-glitter - an Gitter connection manager for Telepathy
+#
+# Copyright (C) 2015 Diane Trout
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Where the time goes between gitter sending a message and clients seeing it
+
+Streamed messages carry a trace dict of wall clock times, stamped as
+they pass each stage:
+
+  sent      the server's sent timestamp
+  received  the bytes were read off the stream
+  decoded   the ingest thread finished decoding the line
+  stored    the Message was added to its room
+  emitted   MessageReceived went out on D-Bus
+
+Finished traces are split into the time spent in each step and kept
+for percentiles, and a sample of them can be logged whole.
+"""
+import collections
+import json
+import logging
+import os
+import random
+import time
+
+from glitter.util import metrics
+
+__all__ = ['LatencyTracker', 'tracker', 'STEPS']
+
+logger = logging.getLogger('Glitter.Latency')
+trace_logger = logging.getLogger('Glitter.Latency.Trace')
+
+# step name -> (from stage, to stage)
+STEPS = collections.OrderedDict([
+    ('network', ('sent', 'received')),
+    ('decode', ('received', 'decoded')),
+    ('store', ('decoded', 'stored')),
+    ('dispatch', ('stored', 'emitted')),
+    ('total', ('sent', 'emitted')),
+])
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# recent durations kept per step for percentiles
+RESERVOIR_SIZE = 2048
+# fraction of traces to log, read once at startup
+SAMPLE_RATE = 'GLITTER_LATENCY_SAMPLE'
+
+
+class LatencyTracker(object):
+    def __init__(self, sample_rate=0.0):
+        self.sample_rate = sample_rate
+        self._durations = {step: collections.deque(maxlen=RESERVOIR_SIZE)
+                           for step in STEPS}
+        self._histogram = metrics.registry().histogram(
+            'glitter_message_latency_seconds',
+            'Time streamed messages spend in each step', ['step'],
+            buckets=LATENCY_BUCKETS)
+
+    def finish(self, message):
+        """Stamp a traced message as emitted and account for its steps
+        """
+        trace = message.trace
+        if trace is None:
+            return
+        message.trace = None
+        trace['emitted'] = time.time()
+        if message.sent_ms is not None:
+            trace['sent'] = message.sent_ms / 1000
+
+        for step, (start, end) in STEPS.items():
+            if start in trace and end in trace:
+                duration = trace[end] - trace[start]
+                self._durations[step].append(duration)
+                # negative network time is clock skew, don't let it
+                # land in the lowest bucket as if it were fast
+                if duration >= 0:
+                    self._histogram.observe(duration, step=step)
+
+        if self.sample_rate and random.random() < self.sample_rate:
+            trace_logger.info("%s", json.dumps(
+                dict(trace, id=message.id), sort_keys=True))
+
+    def report(self):
+        """Return count and p50/p90/p99 in ms of every step
+        """
+        report = {}
+        for step, durations in self._durations.items():
+            ordered = sorted(durations)
+            if not ordered:
+                continue
+            report[step] = {'count': len(ordered)}
+            for name, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99)):
+                index = min(len(ordered) - 1, int(len(ordered) * fraction))
+                report[step][name + '_ms'] = round(ordered[index] * 1000, 3)
+        return report
+
+
+_tracker = None
+
+
+def tracker():
+    """Return the process wide LatencyTracker
+    """
+    global _tracker
+    if _tracker is None:
+        _tracker = LatencyTracker(float(os.environ.get(SAMPLE_RATE, 0)))
+    return _tracker
@@ -0,0 +1,228 @@
+# telepathy-glitter - an Gitter connection manager for Telepathy
+#
+# Copyright (C) 2015 Diane Trout
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Deferred and periodic work on the Qt main loop
+
+Everything glitter runs later goes through one MainLoopScheduler
+instead of a QTimer per call, so the queued work can be measured and
+kept from starving D-Bus dispatch.
+"""
+from PyQt5.QtCore import QObject, QTimer
+
+import collections
+import heapq
+import itertools
+import logging
+import time
+
+__all__ = ['MainLoopScheduler', 'scheduler']
+
+logger = logging.getLogger('Glitter.MainLoop')
+
+# seconds of queued work run per main loop iteration before yielding
+DEFAULT_BUDGET = 0.01
+
+
+class Job(object):
+    """A delayed or periodic call, cancel() stops it
+    """
+    __slots__ = ('due', 'interval', 'func', 'args', 'kwargs', 'cancelled')
+
+    def __init__(self, due, interval, func, args, kwargs):
+        self.due = due
+        self.interval = interval
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _Throttle(object):
+    __slots__ = ('min_delay', 'last_call', 'calls', 'job')
+
+    def __init__(self, min_delay):
+        self.min_delay = min_delay
+        self.last_call = None
+        self.calls = collections.deque()
+        self.job = None
+
+
+class MainLoopScheduler(QObject):
+    """Idle queue, delayed jobs and named throttles sharing two QTimers
+
+    Idle calls run in order on the next main loop iteration. Delayed
+    and periodic jobs sit in a heap ordered by due time, with a single
+    timer armed for the earliest one. Each iteration runs at most
+    budget seconds of work, whatever is left waits for the next one so
+    pending D-Bus messages get dispatched in between.
+    """
+    def __init__(self, budget=DEFAULT_BUDGET):
+        super().__init__()
+        self.budget = budget
+        # (enqueued at, func, args, kwargs)
+        self._idle = collections.deque()
+        # (due, sequence, job)
+        self._timers = []
+        self._sequence = itertools.count()
+        self._throttles = {}
+
+        self._idleTimer = QTimer()
+        self._idleTimer.setSingleShot(True)
+        self._idleTimer.timeout.connect(self._run)
+        self._timerTimer = QTimer()
+        self._timerTimer.setSingleShot(True)
+        self._timerTimer.timeout.connect(self._run)
+
+        self.ran = 0
+        self.yields = 0
+        self.lastLag = 0.0
+        self.maxLag = 0.0
+
+    def idle(self, func, *args, **kwargs):
+        """Call func on the next main loop iteration
+        """
+        self._idle.append((time.monotonic(), func, args, kwargs))
+        if not self._idleTimer.isActive():
+            self._idleTimer.start(0)
+
+    def callLater(self, delay, func, *args, **kwargs):
+        """Call func after delay ms, returning its Job
+        """
+        return self._add(Job(time.monotonic() + delay / 1000, None,
+                             func, args, kwargs))
+
+    def callEvery(self, interval, func, *args, **kwargs):
+        """Call func every interval ms until the returned Job is cancelled
+        """
+        return self._add(Job(time.monotonic() + interval / 1000, interval / 1000,
+                             func, args, kwargs))
+
+    def throttle(self, name, min_delay, func, *args, **kwargs):
+        """Call func now, or queue it so calls sharing name run min_delay ms apart
+        """
+        throttle = self._throttles.get(name)
+        if throttle is None:
+            throttle = self._throttles[name] = _Throttle(min_delay / 1000)
+        now = time.monotonic()
+        if (not throttle.calls and (throttle.last_call is None or
+                now - throttle.last_call >= throttle.min_delay)):
+            throttle.last_call = now
+            func(*args, **kwargs)
+            return
+        throttle.calls.append((func, args, kwargs))
+        if throttle.job is None:
+            self._armThrottle(throttle)
+
+    def _armThrottle(self, throttle):
+        wait = max(0, throttle.last_call + throttle.min_delay - time.monotonic())
+        throttle.job = self.callLater(wait * 1000, self._runThrottle, throttle)
+
+    def _runThrottle(self, throttle):
+        func, args, kwargs = throttle.calls.popleft()
+        throttle.last_call = time.monotonic()
+        throttle.job = None
+        if throttle.calls:
+            self._armThrottle(throttle)
+        func(*args, **kwargs)
+
+    def _add(self, job):
+        heapq.heappush(self._timers, (job.due, next(self._sequence), job))
+        if self._timers[0][2] is job:
+            self._armTimer()
+        return job
+
+    def _armTimer(self):
+        while self._timers and self._timers[0][2].cancelled:
+            heapq.heappop(self._timers)
+        if self._timers:
+            wait = max(0, self._timers[0][0] - time.monotonic())
+            self._timerTimer.start(int(wait * 1000 + 0.999))
+        else:
+            self._timerTimer.stop()
+
+    def _call(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logger.exception("Scheduled call to %s failed",
+                             getattr(func, '__qualname__', func))
+        self.ran += 1
+
+    def _run(self):
+        now = start = time.monotonic()
+        deadline = start + self.budget
+
+        # overdue timers first so a long idle queue can't starve them
+        while self._timers and self._timers[0][0] <= now and now <= deadline:
+            due, _, job = heapq.heappop(self._timers)
+            if job.cancelled:
+                continue
+            self._recordLag(now - due)
+            if job.interval is not None:
+                job.due = max(due + job.interval, now)
+                heapq.heappush(self._timers, (job.due, next(self._sequence), job))
+            self._call(job.func, job.args, job.kwargs)
+            now = time.monotonic()
+
+        # jobs queued while running wait for the next iteration, at
+        # least one runs each time so the queue always makes progress
+        for _ in range(len(self._idle)):
+            queued, func, args, kwargs = self._idle.popleft()
+            self._recordLag(start - queued)
+            self._call(func, args, kwargs)
+            if time.monotonic() > deadline:
+                break
+
+        if self._idle:
+            # more work is waiting, let Qt dispatch events before carrying on
+            self.yields += 1
+            self._idleTimer.start(0)
+        self._armTimer()
+
+    def _recordLag(self, lag):
+        self.lastLag = lag
+        if lag > self.maxLag:
+            self.maxLag = lag
+
+    def status(self):
+        """Return queue depths and how late queued work has been run
+        """
+        return {
+            'idle_depth': len(self._idle),
+            'timer_depth': sum(1 for _, _, job in self._timers if not job.cancelled),
+            'throttled_depth': sum(len(t.calls) for t in self._throttles.values()),
+            'ran': self.ran,
+            'yields': self.yields,
+            'last_lag_ms': int(self.lastLag * 1000),
+            'max_lag_ms': int(self.maxLag * 1000),
+        }
+
+
+_scheduler = None
+
+
+def scheduler():
+    """Return the process wide MainLoopScheduler, creating it on first use
+    """
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = MainLoopScheduler()
+    return _scheduler
@@ -0,0 +1,301 @@
+# telepathy-glitter - an Gitter connection manager for Telepathy
+#
+# Copyright (C) 2015 Diane Trout
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Counters, gauges and histograms describing the running connection manager
+
+Metrics live in one process wide Registry. Values that are cheaper to
+read than to track, like queue depths, are filled in by collectors
+right before the registry is read. The registry can be dumped as a
+dict or in the Prometheus text format.
+"""
+import bisect
+import collections
+import logging
+import resource
+import weakref
+
+from glitter.util import mainloop
+from glitter.util.storage import write_atomic
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'Registry', 'registry',
+           'TextfileExporter', 'instrumentBus']
+
+logger = logging.getLogger('Glitter.Metrics')
+
+# seconds, for request latencies
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _labelKey(labelnames, labels):
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _formatLabels(labelnames, key, extra=()):
+    pairs = list(zip(labelnames, key)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs) + '}'
+
+
+def _formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def clear(self, **labels):
+        """Drop every sample, or only those with the given label values
+        """
+        if not labels:
+            self._values.clear()
+            return
+        match = [(self.labelnames.index(name), str(value))
+                 for name, value in labels.items()]
+        for key in [key for key in self._values
+                    if all(key[i] == value for i, value in match)]:
+            del self._values[key]
+
+    def samples(self):
+        """Yield (suffix, label key, extra labels, value)
+        """
+        for key, value in sorted(self._values.items()):
+            yield '', key, (), value
+
+    def snapshot(self):
+        return [dict(zip(self.labelnames, key), value=value)
+                for key, value in sorted(self._values.items())]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = _labelKey(self.labelnames, labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[_labelKey(self.labelnames, labels)] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = _labelKey(self.labelnames, labels)
+        state = self._values.get(key)
+        if state is None:
+            # per bucket counts, sum, count
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                yield '_bucket', key, (('le', _formatValue(bound)),), cumulative
+            yield '_sum', key, (), total
+            yield '_count', key, (), count
+
+    def snapshot(self):
+        return [dict(zip(self.labelnames, key),
+                     buckets=dict(zip(map(_formatValue, self.buckets + (float('inf'),)),
+                                      counts)),
+                     sum=total, count=count)
+                for key, (counts, total, count) in sorted(self._values.items())]
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._collectors = []
+
+    def _register(self, cls, name, *args, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            metric = self._metrics[name] = cls(name, *args, **kwargs)
+        elif not isinstance(metric, cls):
+            raise ValueError("{} is already a {}".format(name, metric.kind))
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._register(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._register(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram, name, help, labelnames, buckets)
+
+    def addCollector(self, callback):
+        """Call callback before every read of the registry
+
+        Bound methods are held weakly, so collectors go away with
+        their object.
+        """
+        if hasattr(callback, '__self__'):
+            self._collectors.append(weakref.WeakMethod(callback))
+        else:
+            self._collectors.append(lambda: callback)
+
+    def collect(self):
+        live = []
+        for ref in self._collectors:
+            callback = ref()
+            if callback is not None:
+                callback()
+                live.append(ref)
+        self._collectors = live
+
+    def snapshot(self):
+        """Return every metric as a json friendly dict
+        """
+        self.collect()
+        return {name: {'type': metric.kind, 'help': metric.help,
+                       'values': metric.snapshot()}
+                for name, metric in self._metrics.items()}
+
+    def exposition(self):
+        """Return every metric in the Prometheus text format
+        """
+        self.collect()
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append('# HELP {} {}'.format(name, metric.help))
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            for suffix, key, extra, value in metric.samples():
+                lines.append('{}{}{} {}'.format(
+                    name, suffix, _formatLabels(metric.labelnames, key, extra),
+                    _formatValue(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def _residentBytes():
+    try:
+        with open('/proc/self/statm') as instream:
+            return int(instream.read().split()[1]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        # peak rather than current, but better than nothing
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+_registry = None
+
+
+def registry():
+    """Return the process wide Registry
+    """
+    global _registry
+    if _registry is None:
+        _registry = Registry()
+        resident = _registry.gauge(
+            'glitter_resident_memory_bytes', 'Resident set size of the process')
+        _registry.addCollector(lambda: resident.set(_residentBytes()))
+    return _registry
+
+
+class TextfileExporter(object):
+    """Periodically write the registry for node_exporter's textfile collector
+    """
+    def __init__(self, filename, interval, metrics=None):
+        self.filename = filename
+        self.interval = interval
+        self._registry = metrics or registry()
+        self._job = None
+
+    def start(self):
+        self.write()
+        self._job = mainloop.scheduler().callEvery(self.interval, self.write)
+
+    def stop(self):
+        if self._job is not None:
+            self._job.cancel()
+            self._job = None
+
+    def write(self):
+        try:
+            write_atomic(self.filename,
+                         self._registry.exposition().encode('utf-8'))
+        except OSError as e:
+            logger.warning("Unable to write metrics to %s: %s", self.filename, e)
+
+
+def _payloadSize(value):
+    """Rough marshalled size of D-Bus values
+    """
+    if isinstance(value, str):
+        return len(value.encode('utf-8')) + 5
+    if isinstance(value, (bytes, bytearray)):
+        return len(value) + 4
+    if isinstance(value, dict):
+        return 4 + sum(_payloadSize(k) + _payloadSize(v)
+                       for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 4 + sum(_payloadSize(v) for v in value)
+    return 8
+
+
+def instrumentBus(bus, metrics=None, payloadBytes=False):
+    """Count the signals sent on bus
+
+    payloadBytes also counts their approximate bytes, which means
+    unmarshalling every signal again, so it is left off by default.
+    """
+    import dbus.lowlevel
+    metrics = metrics or registry()
+    signals = metrics.counter(
+        'glitter_dbus_signals_total', 'D-Bus signals emitted', ['signal'])
+    if payloadBytes:
+        signal_bytes = metrics.counter(
+            'glitter_dbus_signal_bytes_total',
+            'Approximate payload bytes of D-Bus signals emitted', ['signal'])
+    send_message = bus.send_message
+
+    def counting_send_message(message):
+        if message.get_type() == dbus.lowlevel.MESSAGE_TYPE_SIGNAL:
+            name = '{}.{}'.format(
+                (message.get_interface() or '').rsplit('.', 1)[-1],
+                message.get_member())
+            signals.inc(signal=name)
+            if payloadBytes:
+                signal_bytes.inc(_payloadSize(message.get_args_list()),
+                                 signal=name)
+        return send_message(message)
+
+    bus.send_message = counting_send_message
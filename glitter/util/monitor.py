@@ -0,0 +1,180 @@
+# telepathy-glitter - an Gitter connection manager for Telepathy
+#
+# Copyright (C) 2015 Diane Trout
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Measure how responsive the main loop is and catch what blocks it
+
+A precise probe timer records how late each tick fires into a
+histogram. A watchdog thread looks at the main thread's stack whenever
+a tick is overdue by more than the stall threshold, so stalls are
+reported with the handler that was running at the time.
+"""
+from PyQt5.QtCore import QObject, Qt, QTimer
+
+import bisect
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+
+__all__ = ['LoopMonitor']
+
+logger = logging.getLogger('Glitter.Monitor')
+
+PROBE_INTERVAL = 10
+STALL_THRESHOLD = 100
+# upper bounds of the lag histogram buckets, in ms
+LAG_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+MAX_STALLS = 50
+MAX_STACK = 10
+
+_PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# modules that only dispatch to the code we want to blame
+_DISPATCHERS = (os.path.join(_PACKAGE_DIR, 'util', 'mainloop.py'),
+                os.path.abspath(__file__))
+# functions elsewhere that only pass finished replies and decoded
+# payloads on to their callbacks, by file and code name
+_DISPATCH_FUNCTIONS = {
+    os.path.join(_PACKAGE_DIR, 'grequests.py'): frozenset([
+        '_dispatch', '_start', '<lambda>', '_finished', '_complete',
+        '_read', 'resultLater', '_setResult', 'readResponseLater']),
+    os.path.join(_PACKAGE_DIR, 'ingest.py'): frozenset(['_decoded']),
+}
+
+
+def _dispatches(filename, code):
+    return (filename in _DISPATCHERS or
+            code.co_name in _DISPATCH_FUNCTIONS.get(filename, ()))
+
+
+def _describe(frame):
+    """Return the glitter frames of a stack, outermost first
+    """
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.abspath(code.co_filename)
+        if filename.startswith(_PACKAGE_DIR) and not _dispatches(filename, code):
+            name = getattr(code, 'co_qualname', code.co_name)
+            stack.append('{} ({}:{})'.format(
+                name, os.path.relpath(filename, _PACKAGE_DIR), frame.f_lineno))
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+
+class LoopMonitor(QObject):
+    """Main loop lag histogram and stall log
+
+    Times are in milliseconds. report() returns everything collected
+    so far as a json friendly dict.
+    """
+    def __init__(self, interval=PROBE_INTERVAL, threshold=STALL_THRESHOLD):
+        super().__init__()
+        self.interval = interval
+        self.threshold = threshold
+        self._probe = QTimer()
+        self._probe.setTimerType(Qt.PreciseTimer)
+        self._probe.timeout.connect(self._tick)
+        self._histogram = [0] * (len(LAG_BUCKETS) + 1)
+        self._samples = 0
+        self._maxLag = 0.0
+        self._stalls = collections.deque(maxlen=MAX_STALLS)
+        self._lastTick = None
+        # (tick it was taken for, stack) written by the watchdog
+        self._sample = None
+        self._mainThread = threading.get_ident()
+        self._stopping = threading.Event()
+        self._watchdog = None
+
+    def start(self):
+        self._lastTick = time.monotonic()
+        self._probe.start(self.interval)
+        self._stopping.clear()
+        self._watchdog = threading.Thread(
+            target=self._watch, name='glitter-watchdog', daemon=True)
+        self._watchdog.start()
+
+    def stop(self):
+        self._probe.stop()
+        self._stopping.set()
+
+    def _tick(self):
+        now = time.monotonic()
+        last = self._lastTick
+        self._lastTick = now
+        lag = (now - last) * 1000 - self.interval
+        if lag < 0:
+            lag = 0.0
+        self._samples += 1
+        self._histogram[bisect.bisect_left(LAG_BUCKETS, lag)] += 1
+        if lag > self._maxLag:
+            self._maxLag = lag
+
+        if lag >= self.threshold:
+            sample = self._sample
+            stack = sample[1] if sample is not None and sample[0] == last else []
+            handler = stack[0] if stack else 'unknown'
+            logger.warning("Main loop stalled for %dms in %s", lag, handler)
+            self._stalls.append({
+                'at': time.time() - lag / 1000,
+                'duration_ms': int(lag),
+                'handler': handler,
+                'stack': stack[-MAX_STACK:],
+            })
+
+    def _watch(self):
+        while not self._stopping.wait(self.threshold / 4000):
+            last = self._lastTick
+            sample = self._sample
+            if sample is not None and sample[0] == last:
+                # already looked at this stall
+                continue
+            if (time.monotonic() - last) * 1000 - self.interval < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._mainThread)
+            if frame is not None:
+                self._sample = (last, _describe(frame))
+
+    def percentile(self, fraction):
+        """Return the histogram bucket bound below which fraction of lags fall
+        """
+        wanted = self._samples * fraction
+        seen = 0
+        for bound, count in zip(LAG_BUCKETS, self._histogram):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return int(self._maxLag)
+
+    def report(self):
+        histogram = collections.OrderedDict(
+            ('le_{}'.format(bound), count)
+            for bound, count in zip(LAG_BUCKETS, self._histogram))
+        histogram['le_inf'] = self._histogram[-1]
+        return {
+            'interval_ms': self.interval,
+            'threshold_ms': self.threshold,
+            'samples': self._samples,
+            'max_lag_ms': int(self._maxLag),
+            'p50_ms': self.percentile(0.5),
+            'p99_ms': self.percentile(0.99),
+            'histogram': histogram,
+            'stalls': list(self._stalls),
+        }
@@ -0,0 +1,224 @@
+# telepathy-glitter - an Gitter connection manager for Telepathy
+#
+# Copyright (C) 2015 Diane Trout
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Profile a running connection manager without restarting it
+
+Two CPU profilers run for a fixed time and write their results under
+the profiles data directory:
+
+  cprofile  deterministic profile of the main thread, a pstats file
+            for python -m pstats or snakeviz
+  sample    a watchdog style thread samples the main thread's stack,
+            written as collapsed stacks for flamegraph.pl
+
+Memory snapshots start tracemalloc on first use and report what grew
+since the previous snapshot, along with live counts of glitter objects
+so leaking Messages, Rooms or handles stand out.
+"""
+import collections
+import cProfile
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+from glitter.util import mainloop
+from glitter.util.storage import data_dir
+
+__all__ = ['Profiler', 'profiler', 'installSignalHandler', 'MODES']
+
+logger = logging.getLogger('Glitter.Profiling')
+
+MODES = ('cprofile', 'sample')
+# seconds a profile runs for when nobody says otherwise
+DEFAULT_DURATION = 30
+# ms between stack samples
+SAMPLE_INTERVAL = 5
+# frames tracemalloc keeps per allocation
+TRACEMALLOC_FRAMES = 10
+# modules whose live objects are counted in memory snapshots
+_COUNTED_MODULES = ('glitter', 'telepathy')
+
+
+def _collapse(frame):
+    """Return a stack in the collapsed format, outermost first
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('{} ({}:{})'.format(
+            getattr(code, 'co_qualname', code.co_name),
+            os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names)
+
+
+def _countObjects():
+    counts = collections.Counter()
+    for obj in gc.get_objects():
+        cls = type(obj)
+        if cls.__module__.split('.', 1)[0] in _COUNTED_MODULES:
+            counts[cls.__module__ + '.' + cls.__qualname__] += 1
+    return counts
+
+
+class Profiler(object):
+    """At most one CPU profile at a time, plus tracemalloc snapshots
+    """
+    def __init__(self):
+        self._mode = None
+        self._filename = None
+        self._profile = None
+        self._stopJob = None
+        self._sampler = None
+        self._stopping = threading.Event()
+        self._stacks = collections.Counter()
+        self._mainThread = threading.get_ident()
+        self._snapshot = None
+        self._objects = None
+
+    @property
+    def running(self):
+        return self._mode is not None
+
+    def _newFilename(self, kind, extension):
+        return os.path.join(data_dir('profiles'), '{}-{}-{}.{}'.format(
+            kind, time.strftime('%Y%m%dT%H%M%S'), os.getpid(), extension))
+
+    def start(self, mode='cprofile', duration=DEFAULT_DURATION):
+        """Profile for duration seconds, returning where results will go
+        """
+        if mode not in MODES:
+            raise ValueError("Unknown profiler {!r}".format(mode))
+        if self.running:
+            raise RuntimeError("A {} profile is already running".format(self._mode))
+
+        self._mode = mode
+        if mode == 'cprofile':
+            self._filename = self._newFilename(mode, 'pstats')
+            # only sees the thread that enabled it, which is the main loop
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        else:
+            self._filename = self._newFilename(mode, 'folded')
+            self._stacks.clear()
+            self._stopping.clear()
+            self._sampler = threading.Thread(
+                target=self._sample, name='glitter-sampler', daemon=True)
+            self._sampler.start()
+        self._stopJob = mainloop.scheduler().callLater(
+            int(duration * 1000), self.stop)
+        logger.info("Started %s profile for %ds", mode, duration)
+        return self._filename
+
+    def stop(self):
+        """Stop the running profile early and write it, returning the filename
+        """
+        if not self.running:
+            return ''
+        self._stopJob.cancel()
+        if self._mode == 'cprofile':
+            self._profile.disable()
+            self._profile.dump_stats(self._filename)
+            self._profile = None
+        else:
+            self._stopping.set()
+            self._sampler.join()
+            self._sampler = None
+            with open(self._filename, 'w') as outstream:
+                for stack, count in self._stacks.most_common():
+                    outstream.write('{} {}\n'.format(stack, count))
+        logger.info("Wrote %s profile to %s", self._mode, self._filename)
+        filename = self._filename
+        self._mode = self._filename = self._stopJob = None
+        return filename
+
+    def _sample(self):
+        while not self._stopping.wait(SAMPLE_INTERVAL / 1000):
+            frame = sys._current_frames().get(self._mainThread)
+            if frame is not None:
+                self._stacks[_collapse(frame)] += 1
+
+    def memorySnapshot(self, limit=25):
+        """Compare allocations and glitter objects with the previous snapshot
+
+        The first call starts tracemalloc, so it only has the object
+        counts to go on.
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        objects = _countObjects()
+        current, peak = tracemalloc.get_traced_memory()
+
+        report = {
+            'traced_bytes': current,
+            'traced_peak_bytes': peak,
+            'objects': dict(objects.most_common(limit)),
+        }
+        if self._snapshot is not None:
+            report['growth'] = [{
+                'where': str(stat.traceback[0]),
+                'size_diff': stat.size_diff,
+                'count_diff': stat.count_diff,
+                'size': stat.size,
+            } for stat in snapshot.compare_to(self._snapshot, 'lineno')[:limit]]
+            diff = collections.Counter(objects)
+            diff.subtract(self._objects)
+            report['objects_diff'] = {
+                name: count for name, count in diff.most_common(limit)
+                if count}
+        self._snapshot = snapshot
+        self._objects = objects
+        return report
+
+    def stopMemoryTracing(self):
+        """Stop tracemalloc and forget the baseline snapshot
+        """
+        tracemalloc.stop()
+        self._snapshot = self._objects = None
+
+
+_profiler = None
+
+
+def profiler():
+    """Return the process wide Profiler
+    """
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
+
+
+def installSignalHandler(signum, mode='cprofile', duration=DEFAULT_DURATION):
+    """Start a profile when the process receives signum
+    """
+    import signal
+
+    def start():
+        if not profiler().running:
+            profiler().start(mode, duration)
+    signal.signal(signum, lambda *args: mainloop.scheduler().idle(start))
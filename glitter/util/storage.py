@@ -0,0 +1,81 @@
+# telepathy-glitter - an Gitter connection manager for Telepathy
+#
+# Copyright (C) 2015 Diane Trout
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""Locate and write glitter's on-disk state"""
+from PyQt5.QtCore import QStandardPaths
+
+import json
+import logging
+import os
+import tempfile
+from urllib.parse import quote
+
+__all__ = ['data_dir', 'cache_dir', 'account_filename',
+           'write_atomic', 'read_json', 'write_json']
+
+logger = logging.getLogger('Glitter.Storage')
+
+
+def _ensure_dir(location, parts):
+    path = os.path.join(QStandardPaths.writableLocation(location), *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def data_dir(*parts):
+    """Return (and create) a directory under the user data location"""
+    return _ensure_dir(QStandardPaths.DataLocation, parts)
+
+
+def cache_dir(*parts):
+    """Return (and create) a directory under the user cache location"""
+    return _ensure_dir(QStandardPaths.CacheLocation, parts)
+
+
+def account_filename(kind, account):
+    """Return the json file holding one kind of state for an account"""
+    return os.path.join(data_dir(kind), quote(account, safe='') + '.json')
+
+
+def write_atomic(filename, data):
+    """Replace filename with data so readers never see a partial file"""
+    dirname = os.path.dirname(filename)
+    fd, tmpname = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as outstream:
+            outstream.write(data)
+        os.replace(tmpname, filename)
+    except:
+        os.unlink(tmpname)
+        raise
+
+
+def read_json(filename, default=None):
+    """Load a json file, returning default if it is missing or corrupt"""
+    try:
+        with open(filename, 'rb') as instream:
+            return json.loads(instream.read().decode('utf-8'))
+    except FileNotFoundError:
+        return default
+    except ValueError as e:
+        logger.warning("Ignoring corrupt %s: %s", filename, e)
+        return default
+
+
+def write_json(filename, obj):
+    write_atomic(filename, json.dumps(obj).encode('utf-8'))
@@ -0,0 +1,134 @@
+# telepathy-glitter - an Gitter connection manager for Telepathy
+#
+# Copyright (C) 2015 Diane Trout
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+
+"""A cheap record of what the hot paths did recently
+
+Events are tuples of (time, name, args) kept in a fixed size ring, and
+are only turned into text when the ring is dumped. Call sites test the
+module level flag before building their arguments, so tracing costs an
+attribute lookup while it is off:
+
+    if tracing.enabled:
+        tracing.record('stream.lines', room.name, len(lines))
+
+Arguments should be small values; whatever is recorded stays alive
+until it falls out of the ring.
+"""
+import collections
+import json
+import logging
+import os
+import time
+
+from glitter.util import mainloop
+from glitter.util.storage import data_dir, write_atomic
+
+__all__ = ['record', 'enable', 'disable', 'events', 'dump',
+           'dumpToFile', 'installSignalHandler']
+
+logger = logging.getLogger('Glitter.Tracing')
+
+# events kept when tracing is turned on without a size
+DEFAULT_SIZE = 4096
+# ring size to start tracing with, unset leaves it off
+TRACE_SIZE = 'GLITTER_TRACE'
+
+enabled = False
+_ring = collections.deque(maxlen=DEFAULT_SIZE)
+
+
+def record(event, *args):
+    """Append an event to the ring, check enabled first
+    """
+    _ring.append((time.time(), event, args))
+
+
+def enable(size=None):
+    """Start recording, resizing the ring if size is given
+    """
+    global enabled, _ring
+    if size and size != _ring.maxlen:
+        _ring = collections.deque(_ring, maxlen=size)
+    enabled = True
+    logger.info("Tracing the last %d events", _ring.maxlen)
+
+
+def disable():
+    """Stop recording, keeping what was recorded for dumping
+    """
+    global enabled
+    enabled = False
+
+
+def _plain(value):
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_plain(v) for v in value]
+    return str(value)
+
+
+def events():
+    """Return the recorded events, oldest first, as json friendly dicts
+    """
+    return [{'at': at, 'event': event, 'args': _plain(args)}
+            for at, event, args in list(_ring)]
+
+
+def dump():
+    return json.dumps({'enabled': enabled, 'size': _ring.maxlen,
+                       'events': events()})
+
+
+def dumpToFile():
+    """Write the ring to the traces data directory and return the filename
+    """
+    filename = os.path.join(data_dir('traces'), '{}-{}.json'.format(
+        time.strftime('%Y%m%dT%H%M%S'), os.getpid()))
+    write_atomic(filename, dump().encode('utf-8'))
+    logger.info("Wrote %d trace events to %s", len(_ring), filename)
+    return filename
+
+
+def installSignalHandler(signum):
+    """Dump the ring to a file when the process receives signum
+    """
+    import signal
+    # python runs the handler between bytecodes of the main thread,
+    # leave the file writing to the main loop
+    signal.signal(signum, lambda *args: mainloop.scheduler().idle(dumpToFile))
+
+
+def _sizeFromEnvironment():
+    value = os.environ.get(TRACE_SIZE)
+    if not value:
+        return None
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+    if size <= 0:
+        logger.warning("Ignoring %s=%r, tracing the last %d events",
+                       TRACE_SIZE, value, DEFAULT_SIZE)
+        return DEFAULT_SIZE
+    return size
+
+
+_size = _sizeFromEnvironment()
+if _size:
+    enable(_size)